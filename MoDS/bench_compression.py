@@ -0,0 +1,44 @@
+import argparse
+import tqdm
+from data_loader import ConflictDataset
+from model_registry import registry
+from retriever import Retriever, QueryCache
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Memory footprint and recall@k of int8-compressed paragraph embeddings')
+    parser.add_argument('--num_to_run', type=int, default=20, help='Number of data instances to compare')
+    parser.add_argument('--top_k', type=int, default=3, help='k for recall@k')
+    parser.add_argument('--colbert_model_name', type=str, default="colbert-ir/colbertv2.0", help='ColBERT checkpoint')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+
+    checkpoint = registry.get_checkpoint(args.colbert_model_name, 300, 64, 8)
+    full_bytes, compressed_bytes = 0, 0
+    num_found, num_total = 0, 0
+
+    for ds_name in ['Debatepedia', 'ConflictingQA']:
+        ds = ConflictDataset(ds_name, 1)
+        for idx in tqdm.tqdm(range(min(args.num_to_run, ds.length()))):
+            query, docs = ds.get_item(idx)
+            query_cache = QueryCache()
+            full = Retriever(docs, 300, 64, 8, args.colbert_model_name, checkpoint=checkpoint, query_cache=query_cache)
+            compressed = Retriever(docs, 300, 64, 8, args.colbert_model_name, checkpoint=checkpoint, query_cache=query_cache, compress=True)
+            full_bytes += full.memory_bytes()
+            compressed_bytes += compressed.memory_bytes()
+
+            # recall@k of the uncompressed top-k paragraphs of every document
+            full_paras, _ = full.get_doc_candidates(query, args.top_k)
+            compressed_paras, _ = compressed.get_doc_candidates(query, args.top_k)
+            for full_p, compressed_p in zip(full_paras, compressed_paras):
+                num_found += len(set(full_p) & set(compressed_p))
+                num_total += len(full_p)
+
+    print(f'fp16 embeddings: {full_bytes / 2**20:.1f} MiB')
+    print(f'int8 embeddings: {compressed_bytes / 2**20:.1f} MiB ({compressed_bytes / max(1, full_bytes):.2%} of fp16)')
+    print(f'recall@{args.top_k} against fp16: {num_found / max(1, num_total):.4f}')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
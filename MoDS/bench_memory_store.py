@@ -0,0 +1,93 @@
+import argparse
+import copy
+import pickle
+import random
+import time
+from memory import Memory
+from summarizer import Summarizer
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pickle size, checkpoint time and variant forking of memories, fact dicts against the columnar fact tables')
+    parser.add_argument('--num_outlines', type=int, default=20, help='Number of synthetic instances')
+    parser.add_argument('--num_variants', type=int, default=4, help='Variants per instance, all holding the same speaker facts')
+    parser.add_argument('--num_points', type=int, default=5, help='Discussion points per outline')
+    parser.add_argument('--num_docs', type=int, default=50, help='Documents per outline')
+    parser.add_argument('--facts_per_doc', type=int, default=20, help='Facts per document and point')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    return args
+
+class LegacyMemory:
+
+    """ A memory as it was pickled before the fact tables: its plain __dict__ of fact dicts, with no fact index """
+    def __init__(self, memory):
+        self.query = memory.query
+        self.topic_speakers = memory.topic_speakers
+        self.topics = memory.topics
+        self.facts = [{'facts': list(table.facts), 'labels': table['labels'], 'doc_nums': table['doc_nums']} for table in memory.facts]
+        self.rounds = memory.rounds
+
+    def to_memory(self):
+        # what unpickling an old memory does
+        memory = Memory.__new__(Memory)
+        memory.__setstate__(dict(self.__dict__))
+        return memory
+
+def synthetic_instance(args, rng, outline_num):
+    # like mods(): one base memory with the points, forked per variant, each variant collecting the same speaker facts
+    base_memory = Memory(f'Synthetic query {outline_num}?')
+    base_memory.set_topics({f'discussion point {idx + 1}': f'Point {idx + 1}' for idx in range(args.num_points)})
+    speaker_infos = []
+    speaker_facts = []
+    for idx in range(args.num_points):
+        doc_nums = rng.sample(range(args.num_docs), rng.randint(1, args.num_docs))
+        speaker_infos.append({'relevant documents': [doc_num + 1 for doc_num in doc_nums], **{f'document {doc_num + 1} question': f'Question {doc_num + 1}?' for doc_num in doc_nums}})
+        point_facts = []
+        for doc_num in doc_nums:
+            num_yes = rng.randint(0, args.facts_per_doc)
+            # built per call, as parsed from each speaker's json output
+            point_facts.append((doc_num, [f'Yes fact {i} of document {doc_num} on point {idx}.' for i in range(num_yes)], [f'No fact {i} of document {doc_num} on point {idx}.' for i in range(args.facts_per_doc - num_yes)]))
+        speaker_facts.append(point_facts)
+
+    memories = {variant: base_memory.fork() for variant in range(args.num_variants)}
+    for memory in memories.values():
+        for speaker_info, point_facts in zip(speaker_infos, speaker_facts):
+            memory.add_selected_speaker_info(speaker_info)
+            memory.initialize_topic()
+            for doc_num, yes_facts, no_facts in point_facts:
+                memory.add_facts({'yes facts': [''.join(list(fact)) for fact in yes_facts], 'no facts': [''.join(list(fact)) for fact in no_facts]}, doc_num)
+    return base_memory, memories
+
+def main(args):
+
+    rng = random.Random(args.seed)
+    instances = [synthetic_instance(args, rng, outline_num) for outline_num in range(args.num_outlines)]
+    outputs = [memories for _, memories in instances]
+
+    for name, wrap, unwrap in [('fact dicts', lambda memories: {k: LegacyMemory(v) for k, v in memories.items()}, lambda memories: {k: v.to_memory() for k, v in memories.items()}),
+                               ('fact tables', lambda memories: memories, lambda memories: memories)]:
+        start = time.perf_counter()
+        data = [pickle.dumps(wrap(memories), protocol=pickle.HIGHEST_PROTOCOL) for memories in outputs]
+        dump_time = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = [unwrap(pickle.loads(d)) for d in data]
+        load_time = time.perf_counter() - start
+        print(f'{name}: {sum(len(d) for d in data) / 1e6:.2f} MB, dump {dump_time:.3f}s, load {load_time:.3f}s')
+
+        # both formats load into the same memories
+        summarizer = Summarizer(None, args.num_points)
+        for memories, loaded_memories in zip(outputs, loaded):
+            for variant, memory in memories.items():
+                assert summarizer.parse_outline(memory) == summarizer.parse_outline(loaded_memories[variant]), f"The {name} pickle renders a different outline"
+
+    start = time.perf_counter()
+    _ = [[copy.deepcopy(base_memory) for _ in range(args.num_variants)] for base_memory, _ in instances]
+    deepcopy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _ = [[base_memory.fork() for _ in range(args.num_variants)] for base_memory, _ in instances]
+    fork_time = time.perf_counter() - start
+    print(f'variant memories: deepcopy {deepcopy_time * 1e3:.2f}ms, fork {fork_time * 1e3:.2f}ms')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,68 @@
+import argparse
+import random
+import time
+from memory import Memory
+from summarizer import Summarizer
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time outline rendering on large synthetic outlines, scanning every fact per document against the fact index')
+    parser.add_argument('--num_outlines', type=int, default=20, help='Number of synthetic outlines')
+    parser.add_argument('--num_points', type=int, default=5, help='Discussion points per outline')
+    parser.add_argument('--num_docs', type=int, default=50, help='Documents per outline')
+    parser.add_argument('--facts_per_doc', type=int, default=20, help='Facts per document and point')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    return args
+
+def synthetic_outline(args, rng, outline_num):
+    outline = Memory(f'Synthetic query {outline_num}?')
+    outline.set_topics({f'discussion point {idx + 1}': f'Point {idx + 1}' for idx in range(args.num_points)})
+    for idx in range(args.num_points):
+        doc_nums = rng.sample(range(args.num_docs), rng.randint(1, args.num_docs))
+        outline.add_selected_speaker_info({'relevant documents': [doc_num + 1 for doc_num in doc_nums], **{f'document {doc_num + 1} question': f'Question {doc_num + 1}?' for doc_num in doc_nums}})
+        outline.initialize_topic()
+        for doc_num in doc_nums:
+            num_yes = rng.randint(0, args.facts_per_doc)
+            outline.add_facts({'yes facts': [f'Yes fact {i} of {doc_num}.' for i in range(num_yes)], 'no facts': [f'No fact {i} of {doc_num}.' for i in range(args.facts_per_doc - num_yes)]}, doc_num)
+    return outline
+
+def parse_outline_scan(summarizer, outline):
+    # the renderer before the fact index: every fact is scanned again for every document
+    sections = [f'Query: {outline.query}']
+    for idx in range(summarizer.num_points):
+        select_info = outline.topic_speakers[idx]
+        curr_facts = outline.facts[idx]['facts']
+        curr_docs = outline.facts[idx]['doc_nums']
+        curr_labels = outline.facts[idx]['labels']
+        out = f'# Discussion Point {idx+1}: {outline.topics[idx]}'
+        for doc_num in set(curr_docs):
+            out += f'\n## Document {doc_num + 1}: {select_info["document " + str(doc_num + 1) + " question"]}'
+            yes_facts = [f'- Yes Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
+            no_facts = [f'- No Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+            fact_text = "\n".join(yes_facts + no_facts)
+            out += f'\n{fact_text}'
+        sections.append(out)
+    return sections
+
+def main(args):
+
+    rng = random.Random(args.seed)
+    outlines = [synthetic_outline(args, rng, outline_num) for outline_num in range(args.num_outlines)]
+    # the renderers only use num_points, so no llm is needed
+    summarizer = Summarizer(None, args.num_points)
+
+    start = time.perf_counter()
+    scanned = [parse_outline_scan(summarizer, outline) for outline in outlines]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [summarizer.parse_outline(outline) for outline in outlines]
+    index_time = time.perf_counter() - start
+
+    assert scanned == indexed, "The fact index renders different outlines"
+    num_facts = sum(len(facts['facts']) for outline in outlines for facts in outline.facts)
+    print(f'{args.num_outlines} outlines, {num_facts} facts: scan {scan_time:.3f}s, fact index {index_time:.3f}s ({scan_time / max(index_time, 1e-9):.1f}x)')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
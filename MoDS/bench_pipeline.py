@@ -0,0 +1,142 @@
+import argparse
+import contextlib
+import os
+import resource
+import threading
+import time
+import run_mods
+from data_loader import ConflictDataset
+from llm import LLM, ConcurrentLLM
+from call_log import CallLog
+from mock_llm import MockClient
+from model_registry import registry
+from retriever import Retriever
+from summarizer import Summarizer
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end throughput of mods and the summarizers against the offline mock LLM')
+    parser.add_argument('--num_to_run', type=int, default=5, help='Number of data instances to run')
+    parser.add_argument('--ds_name', type=str, default="Debatepedia", help='Dataset split to run')
+    parser.add_argument('--top_k', type=int, default=3, help='Number to retrieve')
+    parser.add_argument('--num_topics', type=int, default=3, help='Number of topics to generate')
+    parser.add_argument('--max_in_flight', type=int, default=8, help='Maximum number of concurrent LLM requests')
+    parser.add_argument('--mock_latency', type=float, default=1.0, help='Mean latency in seconds of the mock backend')
+    parser.add_argument('--mock_failure_rate', type=float, default=0.0, help='Fraction of mock calls failing with a server error')
+    parser.add_argument('--mock_rate_limit_rate', type=float, default=0.0, help='Fraction of mock calls failing with a 429')
+    parser.add_argument('--mock_malformed_rate', type=float, default=0.0, help='Fraction of mock outputs missing a key')
+    parser.add_argument('--json_mode', type=str, default="False", help='Request JSON outputs and repair ones not matching the expected schema?')
+    parser.add_argument('--stream', type=str, default="False", help='Stream completions, logging time-to-first-token and stopping bad JSON outputs early?')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the mock latency and failure draws')
+    args = parser.parse_args()
+    return args
+
+# seconds spent in retrieval summed over threads, and wall seconds during which any thread was retrieving
+retrieval_time = {'seconds': 0.0, 'wall seconds': 0.0, 'active': 0, 'since': 0.0}
+retrieval_lock = threading.Lock()
+retrieval_local = threading.local()
+
+@contextlib.contextmanager
+def timed_retrieval():
+    # only a thread's outermost retrieval call is timed, so e.g. the query encoding inside get_doc_candidates is not
+    # counted twice
+    depth = getattr(retrieval_local, 'depth', 0)
+    retrieval_local.depth = depth + 1
+    start = time.perf_counter()
+    if depth == 0:
+        with retrieval_lock:
+            if retrieval_time['active'] == 0:
+                retrieval_time['since'] = start
+            retrieval_time['active'] += 1
+    try:
+        yield
+    finally:
+        retrieval_local.depth = depth
+        if depth == 0:
+            end = time.perf_counter()
+            with retrieval_lock:
+                retrieval_time['seconds'] += end - start
+                retrieval_time['active'] -= 1
+                if retrieval_time['active'] == 0:
+                    retrieval_time['wall seconds'] += end - retrieval_time['since']
+
+""" Retriever that adds the time spent loading, encoding and scoring to retrieval_time """
+class TimedRetriever(Retriever):
+
+    def __init__(self, *args, **kwargs):
+        # the model load (on first use) and the document encoding
+        with timed_retrieval():
+            super().__init__(*args, **kwargs)
+
+    def encode_queries(self, queries):
+        with timed_retrieval():
+            return super().encode_queries(queries)
+
+    def get_doc_candidates(self, query, top_k):
+        with timed_retrieval():
+            return super().get_doc_candidates(query, top_k)
+
+    def retrieve(self, query, top_k, doc_num, q_embed=None):
+        with timed_retrieval():
+            return super().retrieve(query, top_k, doc_num, q_embed)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and only ever grows, so it is the peak over every stage so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def current_rss_mb():
+    # resident pages right now, from /proc on Linux; None elsewhere
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    with open('/proc/self/statm', 'r') as handle:
+        return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def report(stage, seconds, call_log):
+    totals = call_log.totals
+    rss = current_rss_mb()
+    calls = totals['calls'] + totals['cached calls']
+    print(f"{stage}: {seconds:.2f}s wall, {calls} calls ({calls / max(seconds, 1e-9):.2f}/s), {totals['retries']} retries, "
+          f"{totals['prompt tokens'] + totals['completion tokens']} tokens, {totals['latency']:.2f}s summed LLM latency, {totals['cached prompt tokens'] / max(totals['prompt tokens'], 1):.1%} of prompt tokens cached, "
+          f"RSS {f'{rss:.0f} MB' if rss != None else 'n/a'} at the end of the stage, peak RSS so far {peak_rss_mb():.0f} MB")
+    if totals['streamed calls'] > 0:
+        print(f"{stage}: mean time to first token {totals['ttft'] / totals['streamed calls']:.2f}s")
+
+def build_llm(args, concurrent):
+    # no response cache, so every call pays the mock latency
+    client = MockClient(args.mock_latency, 0.5, args.mock_failure_rate, args.mock_rate_limit_rate, seed=args.seed, malformed_rate=args.mock_malformed_rate)
+    call_log = CallLog()
+    if concurrent:
+        return ConcurrentLLM('GPT4', 0.0, 127000, None, args.max_in_flight, None, call_log, client, args.json_mode == 'True', 2, args.stream == 'True')
+    return LLM('GPT4', 0.0, 127000, None, None, call_log, client, args.json_mode == 'True', 2, args.stream == 'True')
+
+def main(args):
+
+    ds = ConflictDataset(args.ds_name, 1)
+    num_to_run = min(args.num_to_run, ds.length())
+
+    llm = build_llm(args, True)
+    start = time.perf_counter()
+    outlines = []
+    for idx in range(num_to_run):
+        llm.call_log.instance = (args.ds_name, idx)
+        # with CoT the moderator generates the per-document questions the summarizers render
+        outlines.append(run_mods.mods(idx, ds, llm, args.num_topics, args.top_k, [True], [True], True, True, retriever_factory=TimedRetriever)[(True, True)])
+    report('mods', time.perf_counter() - start, llm.call_log)
+    print(f"mods retrieval: {retrieval_time['wall seconds']:.2f}s wall, {retrieval_time['seconds']:.2f}s summed over threads")
+    registry.release()
+
+    for name, concurrent in [('summary full', False), ('summary ind', True)]:
+        llm = build_llm(args, concurrent)
+        summarizer = Summarizer(llm, args.num_topics)
+        start = time.perf_counter()
+        for outline in outlines:
+            if type(outline) == type(''):
+                continue
+            if concurrent:
+                summarizer.summarize_outline_ind_async(outline)
+            else:
+                summarizer.summarize_outline_full(outline)
+        report(name, time.perf_counter() - start, llm.call_log)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,45 @@
+import argparse
+import time
+from colbert.modeling.checkpoint import Checkpoint
+from colbert.infra import ColBERTConfig
+from data_loader import ConflictDataset
+from model_registry import registry
+from retriever import Retriever
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time-to-first-retrieval with and without the shared ColBERT checkpoint')
+    parser.add_argument('--num_to_run', type=int, default=5, help='Number of data instances to time')
+    parser.add_argument('--top_k', type=int, default=3, help='Number to retrieve')
+    parser.add_argument('--colbert_model_name', type=str, default="colbert-ir/colbertv2.0", help='ColBERT checkpoint')
+    args = parser.parse_args()
+    return args
+
+def time_first_retrieval(query, docs, top_k, colbert_model_name, shared):
+    start = time.perf_counter()
+    if shared:
+        retriever = Retriever(docs, 300, 64, 8, colbert_model_name)
+    else:
+        # what every Retriever used to do: load its own checkpoint
+        config = ColBERTConfig(doc_maxlen=300, query_maxlen=64, nbits=8, kmeans_niters=8)
+        checkpoint = Checkpoint(colbert_model_name, colbert_config=config, verbose=0)
+        retriever = Retriever(docs, 300, 64, 8, colbert_model_name, checkpoint=checkpoint)
+    retriever.get_doc_candidates(query, top_k)
+    return time.perf_counter() - start
+
+def main(args):
+
+    ds = ConflictDataset('Debatepedia', 1)
+    num_to_run = min(args.num_to_run, ds.length())
+
+    for shared in [False, True]:
+        registry.release()
+        times = []
+        for idx in range(num_to_run):
+            query, docs = ds.get_item(idx)
+            times.append(time_first_retrieval(query, docs, args.top_k, args.colbert_model_name, shared))
+        name = 'shared checkpoint' if shared else 'checkpoint per retriever'
+        print(f'{name}: first instance {times[0]:.2f}s, later instances {sum(times[1:]) / max(1, len(times) - 1):.2f}s on average, total {sum(times):.2f}s')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
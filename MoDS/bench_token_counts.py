@@ -0,0 +1,62 @@
+import argparse
+import time
+import tiktoken
+from data_loader import ConflictDataset
+from token_counter import count_tokens, fit_to_budget, token_counts
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time speaker source pruning over the whole dataset: per-call encoding, the bounded token count memo, and the counts stored with the dataset')
+    parser.add_argument('--token_limit', type=int, default=127000, help='Token budget of each speaker document')
+    parser.add_argument('--num_passes', type=int, default=3, help='Number of times every speaker is built, e.g. once per variant or script')
+    args = parser.parse_args()
+    return args
+
+def prune_per_call(docs, token_limit, doc_token_counts=None):
+    # what Speaker did before: a fresh encoder, every paragraph encoded again, checked before adding the next one
+    encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
+    pruned_docs = []
+    total_tokens = 0
+    for doc in docs:
+        if total_tokens > token_limit:
+            break
+        pruned_docs.append(doc)
+        total_tokens += len(encoding.encode(doc))
+    return pruned_docs, total_tokens
+
+def prune_memoized(docs, token_limit, doc_token_counts=None):
+    counts = [count_tokens(doc) + 1 for doc in docs]
+    num_kept = fit_to_budget(counts, token_limit)
+    return docs[:num_kept], sum(counts[:num_kept])
+
+def prune_precomputed(docs, token_limit, doc_token_counts):
+    # what Speaker does with a dataset converted by convert_dataset.py
+    counts = [count + 1 for count in doc_token_counts]
+    num_kept = fit_to_budget(counts, token_limit)
+    return docs[:num_kept], sum(counts[:num_kept])
+
+def main(args):
+
+    speaker_docs = []
+    for ds_name in ['Debatepedia', 'ConflictingQA']:
+        ds = ConflictDataset(ds_name, 1)
+        for idx in range(ds.length()):
+            _, docs, doc_token_counts = ds.get_item(idx, True)
+            speaker_docs.extend(zip(docs, doc_token_counts if doc_token_counts != None else [None for _ in docs]))
+    print(f'{len(speaker_docs)} speaker documents, {sum(len(docs_) for docs_, _ in speaker_docs)} paragraphs')
+
+    prunes = [('per-call encoding', prune_per_call), ('bounded memo', prune_memoized)]
+    if all(counts != None for _, counts in speaker_docs):
+        prunes.append(('dataset counts', prune_precomputed))
+    for name, prune in prunes:
+        token_counts.clear()
+        times = []
+        for _ in range(args.num_passes):
+            start = time.perf_counter()
+            results = [prune(docs_, args.token_limit, counts) for docs_, counts in speaker_docs]
+            times.append(time.perf_counter() - start)
+        over_budget = sum(total_tokens > args.token_limit for _, total_tokens in results)
+        print(f'{name}: first pass {times[0]:.2f}s, later passes {sum(times[1:]) / max(1, len(times) - 1):.2f}s on average, {over_budget} documents over the {args.token_limit} token budget')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,46 @@
+import argparse
+import tqdm
+from data_loader import ConflictDataset
+from embedding_store import EmbeddingStore
+from model_registry import registry
+from retriever import encode_paragraphs, set_encoding_threads
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Precompute ColBERT paragraph embeddings for the dataset')
+    parser.add_argument('--store_path', type=str, default="./embedding_store", help='Directory for the embedding store')
+    parser.add_argument('--colbert_model_name', type=str, default="colbert-ir/colbertv2.0", help='ColBERT checkpoint to encode with')
+    parser.add_argument('--doc_maxlen', type=int, default=300, help='Maximum paragraph length in tokens')
+    parser.add_argument('--query_maxlen', type=int, default=64, help='Maximum query length in tokens')
+    parser.add_argument('--nbits', type=int, default=8, help='ColBERT nbits')
+    parser.add_argument('--bsize', type=int, default=64, help='Encoding batch size')
+    parser.add_argument('--num_threads', type=int, default=1, help='Number of encoding threads')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+
+    set_encoding_threads(args.num_threads)
+    checkpoint = registry.get_checkpoint(args.colbert_model_name, args.doc_maxlen, args.query_maxlen, args.nbits)
+    store = EmbeddingStore(args.store_path)
+
+    for ds_name in ['Debatepedia', 'ConflictingQA']:
+        ds = ConflictDataset(ds_name, 1)
+        num_added = 0
+        for idx in tqdm.tqdm(range(ds.length())):
+            _, docs = ds.get_item(idx)
+            keys = [EmbeddingStore.doc_key(docs_, args.colbert_model_name, args.doc_maxlen) for docs_ in docs]
+            missing = [doc_num for doc_num, key in enumerate(keys) if not store.contains(key)]
+
+            # encode the paragraphs of every missing document of the instance together
+            para_embeds = encode_paragraphs(checkpoint, [para for doc_num in missing for para in docs[doc_num]], args.bsize, args.num_threads)
+            start = 0
+            for doc_num in missing:
+                store.add(keys[doc_num], para_embeds[start:start + len(docs[doc_num])])
+                start += len(docs[doc_num])
+                num_added += 1
+        store.save()
+        print(f'{ds_name}: added {num_added} documents, store has {len(store.docs)} documents and {store.num_tokens} tokens')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,148 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+from token_counter import count_tokens
+
+class BudgetExceeded(Exception):
+    pass
+
+""" Per-call LLM accounting (latency, tokens, retries, caller), exported as JSONL, with an optional hard budget """
+class CallLog():
+
+    def __init__(self, path=None, usd_per_1k_prompt=0.0, usd_per_1k_completion=0.0, max_calls=0, max_tokens=0, max_usd=0.0):
+        self.path = path
+        self.usd_per_1k_prompt = usd_per_1k_prompt
+        self.usd_per_1k_completion = usd_per_1k_completion
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_usd = max_usd
+        self.instance = None
+        # per-thread instance overrides, for pools running the calls of many instances at once
+        self.local = threading.local()
+        self.totals = self.empty_totals()
+        # calls that passed the budget check and have not been recorded yet, with their estimated prompt tokens and cost
+        self.reserved = {'calls': 0, 'tokens': 0, 'usd': 0.0}
+        self.instance_totals = dict()
+        self.lock = threading.Lock()
+
+    def empty_totals(self):
+        return {'calls': 0, 'cached calls': 0, 'retries': 0, 'errors': 0, 'prompt tokens': 0, 'cached prompt tokens': 0, 'completion tokens': 0, 'usd': 0.0, 'latency': 0.0, 'streamed calls': 0, 'ttft': 0.0}
+
+    def cost(self, prompt_tokens, completion_tokens):
+        return prompt_tokens / 1000 * self.usd_per_1k_prompt + completion_tokens / 1000 * self.usd_per_1k_completion
+
+    def check_budget(self, prompt):
+        # reserves the next call and its prompt's tokens, so calls in flight at once cannot all pass the check and
+        # overspend together; returns the reservation, which record releases
+        if self.max_calls <= 0 and self.max_tokens <= 0 and self.max_usd <= 0:
+            return None
+        est_tokens = count_tokens(prompt) if self.max_tokens > 0 or self.max_usd > 0 else 0
+        reservation = {'calls': 1, 'tokens': est_tokens, 'usd': self.cost(est_tokens, 0)}
+        with self.lock:
+            totals, reserved = self.totals, self.reserved
+            if self.max_calls > 0 and totals['calls'] + reserved['calls'] + 1 > self.max_calls:
+                raise BudgetExceeded(f"Call budget of {self.max_calls} reached")
+            if self.max_tokens > 0 and totals['prompt tokens'] + totals['completion tokens'] + reserved['tokens'] + est_tokens > self.max_tokens:
+                raise BudgetExceeded(f"Token budget of {self.max_tokens} reached")
+            if self.max_usd > 0 and totals['usd'] + reserved['usd'] + reservation['usd'] > self.max_usd:
+                raise BudgetExceeded(f"Budget of ${self.max_usd} reached")
+            for k, v in reservation.items():
+                reserved[k] += v
+        return reservation
+
+    @contextlib.contextmanager
+    def for_instance(self, instance):
+        # attributes the calls this thread makes inside the block to instance
+        previous = getattr(self.local, 'instance', None)
+        self.local.instance = (instance,)
+        try:
+            yield
+        finally:
+            self.local.instance = previous
+
+    def current_instance(self):
+        override = getattr(self.local, 'instance', None)
+        return override[0] if override != None else self.instance
+
+    def record(self, tag, latency, usage=None, retry_reason=None, error=None, cached=False, ttft=None, tokens_per_sec=None, reservation=None):
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        # prompt tokens served from the provider's prompt cache, when the API reports them
+        instance = self.current_instance()
+        cached_prompt_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+        entry = {
+            'time': time.time(),
+            'instance': instance,
+            'tag': tag,
+            'latency': latency,
+            'prompt tokens': prompt_tokens,
+            'cached prompt tokens': cached_prompt_tokens,
+            'completion tokens': completion_tokens,
+            'usd': self.cost(prompt_tokens, completion_tokens),
+            'retry reason': retry_reason,
+            'error': error,
+            'cached': cached,
+            'ttft': ttft,
+            'tokens per sec': tokens_per_sec
+        }
+
+        with self.lock:
+            # the call's actual usage replaces what check_budget reserved for it
+            if reservation != None:
+                for k, v in reservation.items():
+                    self.reserved[k] -= v
+            for totals in [self.totals, self.instance_totals.setdefault(str(instance), self.empty_totals())]:
+                totals['calls' if not cached else 'cached calls'] += 1
+                totals['retries'] += int(retry_reason != None)
+                totals['errors'] += int(error != None)
+                totals['prompt tokens'] += prompt_tokens
+                totals['cached prompt tokens'] += cached_prompt_tokens
+                totals['completion tokens'] += completion_tokens
+                totals['usd'] += entry['usd']
+                totals['latency'] += latency
+                totals['streamed calls'] += int(ttft != None)
+                totals['ttft'] += ttft if ttft != None else 0.0
+            if self.path != None:
+                with open(self.path, 'a') as handle:
+                    handle.write(json.dumps(entry) + '\n')
+
+def reset_call_log(path):
+    # a run that does not resume starts a new call log, as it starts new journals; workers append to it afterwards
+    if os.path.exists(path):
+        os.remove(path)
+
+def summarize_call_log(jsonl_path, csv_path):
+    # aggregates a (possibly multi-process) call log per instance and tag into a CSV, and returns the run totals
+    rows = dict()
+    run_totals = {'calls': 0, 'cached calls': 0, 'retries': 0, 'errors': 0, 'prompt tokens': 0, 'completion tokens': 0, 'usd': 0.0, 'latency': 0.0, 'cached prompt tokens': 0, 'streamed calls': 0, 'ttft': 0.0}
+    # no log file means no call was made, e.g. when every instance failed before calling the llm
+    lines = open(jsonl_path, 'r') if os.path.exists(jsonl_path) else contextlib.nullcontext([])
+    with lines as handle:
+        for line in handle:
+            entry = json.loads(line)
+            for totals in [rows.setdefault((str(entry['instance']), entry['tag']), dict()), run_totals]:
+                totals['calls'] = totals.get('calls', 0) + int(not entry['cached'])
+                totals['cached calls'] = totals.get('cached calls', 0) + int(entry['cached'])
+                totals['retries'] = totals.get('retries', 0) + int(entry['retry reason'] != None)
+                totals['errors'] = totals.get('errors', 0) + int(entry['error'] != None)
+                for k in ['prompt tokens', 'completion tokens', 'usd', 'latency']:
+                    totals[k] = totals.get(k, 0) + entry[k]
+                # logs written before streaming and prompt cache accounting have no ttft or cached prompt tokens
+                totals['cached prompt tokens'] = totals.get('cached prompt tokens', 0) + entry.get('cached prompt tokens', 0)
+                totals['streamed calls'] = totals.get('streamed calls', 0) + int(entry.get('ttft') != None)
+                totals['ttft'] = totals.get('ttft', 0) + (entry.get('ttft') or 0.0)
+
+    fields = ['calls', 'cached calls', 'retries', 'errors', 'prompt tokens', 'cached prompt tokens', 'completion tokens', 'usd', 'latency']
+    with open(csv_path, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['instance', 'tag'] + fields + ['cached token ratio', 'mean ttft'])
+        for (instance, tag), totals in sorted(rows.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            writer.writerow([instance, tag] + [totals[k] for k in fields] + [cached_token_ratio(totals), totals['ttft'] / totals['streamed calls'] if totals['streamed calls'] > 0 else ''])
+    run_totals['cached token ratio'] = cached_token_ratio(run_totals)
+    return run_totals
+
+def cached_token_ratio(totals):
+    return totals.get('cached prompt tokens', 0) / totals['prompt tokens'] if totals.get('prompt tokens', 0) > 0 else 0.0
@@ -0,0 +1,35 @@
+import argparse
+import datasets
+import os
+import pickle
+from token_counter import count_tokens
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert ds.pkl into one memory-mapped Arrow partition per split, with per-paragraph token counts')
+    parser.add_argument('--in_path', type=str, default="ds.pkl", help='Pickled dataset to convert')
+    parser.add_argument('--out_path', type=str, default="ds_arrow", help='Output directory, with one subdirectory per split')
+    parser.add_argument('--split', type=str, default="", help='Split name, if the pickle holds a single split rather than a DatasetDict')
+    parser.add_argument('--num_proc', type=int, default=1, help='Number of processes counting tokens')
+    args = parser.parse_args()
+    return args
+
+def add_doc_token_counts(batch):
+    return {'doc_token_counts': [[[count_tokens(para) for para in docs_] for docs_ in docs] for docs in batch['doc_texts']]}
+
+def main(args):
+
+    with open(args.in_path, 'rb') as handle:
+        ds = pickle.load(handle)
+    if not isinstance(ds, datasets.DatasetDict):
+        assert args.split != '', "The pickle holds a single split, so pass its name with --split"
+        ds = datasets.DatasetDict({args.split: ds if isinstance(ds, datasets.Dataset) else datasets.Dataset.from_dict(ds)})
+
+    for split, split_ds in ds.items():
+        split_ds = split_ds.map(add_doc_token_counts, batched=True, num_proc=args.num_proc if args.num_proc > 1 else None)
+        # a single shard, so a row is one slice of one memory-mapped file
+        split_ds.save_to_disk(os.path.join(args.out_path, split), num_shards=1)
+        print(f'{split}: {len(split_ds)} instances')
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -1,19 +1,30 @@
 import datasets
 import os
+import pickle
+
 class ConflictDataset():
 
     """ Initialize the dataset """
-    def __init__(self, split, doc_span):
+    def __init__(self, split, doc_span, path='ds_arrow'):
         assert doc_span > 0, "Invalid doc span"
-    
-        with open('ds.pkl', 'rb') as handle:
-            self.ds = pickle.load(handle)
-            
-        self.queries = self.ds['query']
-        self.docs = self.ds['doc_texts']
 
-    def get_item(self, idx):
-        return self.queries[idx], self.docs[idx]
+        if os.path.isdir(os.path.join(path, split)):
+            # one memory-mapped Arrow partition per split (see convert_dataset.py): opening it reads no rows,
+            # and every process mapping it shares the same pages
+            self.ds = datasets.load_from_disk(os.path.join(path, split))
+        else:
+            with open('ds.pkl', 'rb') as handle:
+                self.ds = pickle.load(handle)
+            if isinstance(self.ds, datasets.DatasetDict):
+                self.ds = self.ds[split]
+
+    def get_item(self, idx, with_token_counts=False):
+        # only reads the row for idx; with_token_counts also returns its per-paragraph token counts, or None for a
+        # dataset converted without them
+        row = self.ds[idx]
+        if with_token_counts:
+            return row['query'], row['doc_texts'], row.get('doc_token_counts')
+        return row['query'], row['doc_texts']
 
     def length(self):
-        return len(self.queries)
+        return len(self.ds)
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+
+""" Memory-mapped fp16 store of ColBERT paragraph embeddings, keyed by a content hash of each document """
+class EmbeddingStore():
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.tokens_path = os.path.join(path, 'tokens.f16')
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as handle:
+                index = json.load(handle)
+        else:
+            index = {'dim': None, 'num_tokens': 0, 'docs': {}}
+        self.dim = index['dim']
+        self.num_tokens = index['num_tokens']
+        self.docs = index['docs']
+        self.tokens = None
+        self.open_tokens()
+
+    def open_tokens(self):
+        # copy-on-write memmap: nothing writes to it, so every process opening the store reads the same page cache pages,
+        # and unlike a read-only map it gives torch writable arrays to wrap without a copy
+        if self.num_tokens > 0:
+            self.tokens = np.memmap(self.tokens_path, dtype=np.float16, mode='c', shape=(self.num_tokens, self.dim))
+
+    @staticmethod
+    def doc_key(paragraphs, colbert_model_name, doc_maxlen):
+        key_data = json.dumps([colbert_model_name, doc_maxlen, list(paragraphs)], ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def contains(self, key):
+        return key in self.docs
+
+    def get(self, key):
+        # one [num_tokens, dim] fp16 tensor per paragraph, backed by the memmap
+        spans = self.docs[key]
+        return [torch.from_numpy(np.asarray(self.tokens[start:start + length])) for start, length in spans]
+
+    def get_doc(self, key):
+        # the [num_tokens, dim] fp16 tokens of every paragraph of the document as one view of the memmap, which add wrote
+        # contiguously, and the number of tokens of each paragraph
+        spans = self.docs[key]
+        para_lens = [length for _, length in spans]
+        start = spans[0][0] if len(spans) > 0 else 0
+        if any(span_start != start + offset for (span_start, _), offset in zip(spans, np.cumsum([0] + para_lens[:-1]))):
+            return torch.cat(self.get(key)), para_lens
+        return torch.from_numpy(np.asarray(self.tokens[start:start + sum(para_lens)])), para_lens
+
+    def add(self, key, para_embeds):
+        # para_embeds is one [num_tokens, dim] tensor per paragraph, as returned by split_paragraphs
+        if key in self.docs:
+            return
+        if self.dim == None:
+            self.dim = para_embeds[0].shape[-1]
+
+        spans = []
+        with open(self.tokens_path, 'ab') as handle:
+            for para_embed in para_embeds:
+                para_embed = para_embed.to('cpu').to(torch.float16)
+                spans.append((self.num_tokens, para_embed.shape[0]))
+                handle.write(para_embed.numpy().tobytes())
+                self.num_tokens += para_embed.shape[0]
+        self.docs[key] = spans
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump({'dim': self.dim, 'num_tokens': self.num_tokens, 'docs': self.docs}, handle)
+        os.replace(tmp_path, self.index_path)
+        self.open_tokens()
+
+def split_paragraphs(doc_embed):
+    # docFromText zeroes the padding rows of its padded [num_paragraphs, max_len, dim] output, so drop them
+    return [para_embed[para_embed.abs().sum(dim=-1) > 0] for para_embed in doc_embed.to('cpu').to(torch.float16)]
@@ -0,0 +1,133 @@
+import os
+import pickle
+import struct
+import time
+
+""" Append-only journal of finished instances for one (use_cot, use_rationale) variant, as length-prefixed records that
+readers can stream, or follow while the run is still appending to it """
+
+MAGIC = b'JOURNAL2'
+# each record is the lengths of its key and output, the pickled (ds_name, idx, errored) key, then the pickled output,
+# so a scan of the keys can skip the outputs
+HEADER = struct.Struct('<QQ')
+# dataset name of the record closing a run, whose output holds the run's {dataset: number of instances}
+END = '__end__'
+
+def scan_records(path, follow=False, poll=1.0, timeout=0.0, keys_only=False):
+    # yields ((ds_name, idx, output), offset after it) one at a time, or ((ds_name, idx, errored), offset) with keys_only.
+    # A cut-off record ends a plain scan; when following, it is read again once the writer has finished it, until the end
+    # record or timeout seconds (0 for none) without a new record
+    last_record = time.time()
+    while follow and not os.path.exists(path):
+        if timeout > 0 and time.time() - last_record > timeout:
+            return
+        time.sleep(poll)
+    if not os.path.exists(path):
+        return
+
+    with open(path, 'rb') as handle:
+        magic = handle.read(len(MAGIC))
+        assert magic == MAGIC[:len(magic)], f"{path} is not a journal"
+
+        offset = len(magic)
+        while True:
+            handle.seek(offset)
+            header = handle.read(HEADER.size) if offset >= len(MAGIC) else b''
+            lengths = HEADER.unpack(header) if len(header) == HEADER.size else None
+            key_data = handle.read(lengths[0]) if lengths != None else b''
+            if lengths != None and len(key_data) == lengths[0] and offset + HEADER.size + sum(lengths) <= os.fstat(handle.fileno()).st_size:
+                offset += HEADER.size + sum(lengths)
+                last_record = time.time()
+                ds_name, idx, errored = pickle.loads(key_data)
+                yield ((ds_name, idx, errored) if keys_only else (ds_name, idx, pickle.loads(handle.read(lengths[1])))), offset
+                if follow and ds_name == END:
+                    return
+                continue
+
+            if not follow or (timeout > 0 and time.time() - last_record > timeout):
+                return
+            time.sleep(poll)
+            if offset < len(MAGIC):
+                # the writer had not written the magic yet
+                handle.seek(0)
+                magic = handle.read(len(MAGIC))
+                offset = len(magic) if magic == MAGIC else 0
+
+def iter_records(path, follow=False, poll=1.0, timeout=0.0):
+    # the (ds_name, idx, output) records of a journal, one at a time, so readers hold a single output in memory
+    for record, _ in scan_records(path, follow, poll, timeout):
+        yield record
+
+def encode_record(ds_name, idx, output):
+    key_data = pickle.dumps((ds_name, idx, type(output) == type('')), protocol=pickle.HIGHEST_PROTOCOL)
+    output_data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(key_data), len(output_data)) + key_data + output_data
+
+class Journal():
+
+    def __init__(self, path, reset=False):
+        self.path = path
+        if reset and os.path.exists(path):
+            os.remove(path)
+        self.completed = set()
+        for ds_name, idx, errored in self.scan_keys():
+            # errored instances are journaled as strings; they are rerun on resume
+            if not errored:
+                self.completed.add((ds_name, idx))
+
+    def scan_keys(self):
+        # the keys of the journaled records, reading no outputs, after dropping a record cut off by a crash and the end
+        # record of a finished run, so later appends stay readable
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'rb') as handle:
+            magic = handle.read(len(MAGIC))
+
+        keys = []
+        record_offset, good_offset = 0, len(MAGIC) if magic == MAGIC else 0
+        for key, offset in scan_records(self.path, keys_only=True):
+            keys.append(key)
+            record_offset, good_offset = good_offset, offset
+
+        if len(keys) > 0 and keys[-1][0] == END:
+            keys.pop()
+            good_offset = record_offset
+        if good_offset < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as handle:
+                handle.truncate(good_offset)
+        return keys
+
+    def append(self, ds_name, idx, output):
+        data = encode_record(ds_name, idx, output)
+        with open(self.path, 'ab') as handle:
+            if handle.tell() == 0:
+                handle.write(MAGIC)
+            # one write, so a follower sees the header and the record together or a cut-off record it waits on
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        if type(output) != type(''):
+            self.completed.add((ds_name, idx))
+
+    def finish(self, sizes):
+        # tells followers the run is over; the next run appending to the journal drops it again
+        self.append(END, None, sizes)
+
+    def is_completed(self, ds_name, idx):
+        return (ds_name, idx) in self.completed
+
+    def outputs_by_index(self, ds_names):
+        # the later record for an instance wins, so a resumed rerun replaces an earlier error
+        outputs = {ds_name: dict() for ds_name in ds_names}
+        for ds_name, idx, output in iter_records(self.path):
+            if ds_name != END:
+                outputs.setdefault(ds_name, dict())[idx] = output
+        return outputs
+
+    def compact(self, ds_names, sizes=None):
+        # {dataset: [output, ...]} by index, with the placeholder merge_shards.py uses at each index never journaled, so a
+        # gap never shifts the outputs after it; without sizes, the lists end at the last journaled index
+        outputs = self.outputs_by_index(ds_names)
+        sizes = sizes if sizes != None else dict()
+        return {ds_name: [v.get(idx, f'Missing instance {idx}') for idx in range(sizes.get(ds_name, max(v.keys(), default=-1) + 1))] for ds_name, v in outputs.items()}
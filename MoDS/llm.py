@@ -1,42 +1,183 @@
+import contextlib
 import json
 from openai import AzureOpenAI, OpenAI
+from concurrent.futures import Future, ThreadPoolExecutor
+from rate_limiter import backoff_delay, get_retry_after, is_rate_limit_error
+from output_schema import validate, describe
+from stream_monitor import JSONStreamMonitor
+from token_counter import count_tokens
+from types import SimpleNamespace
 import os
 import re
+import threading
 import time
 
+class StreamAborted(Exception):
+    def __init__(self, reason, usage=None, ttft=None, tokens_per_sec=None):
+        super().__init__(reason)
+        self.usage = usage
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+
 """ Basic LLM for all experiments """
 class LLM():
-    def __init__(self, model, temp, token_limit):
+    def __init__(self, model, temp, token_limit, cache=None, rate_limiter=None, call_log=None, client=None, json_mode=False, max_repairs=2, stream=False):
         self.model = model
         self.temp = temp
-        self.client = AzureOpenAI(
+        # with json_mode, calls given a schema ask for a JSON object and fix bad outputs with short repair calls
+        self.json_mode = json_mode
+        self.max_repairs = max_repairs
+        # with stream, completions are read as they arrive, for time-to-first-token and early aborts
+        self.stream = stream
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.call_log = call_log
+        # any object with the chat.completions.create interface can stand in for Azure, e.g. mock_llm.MockClient
+        self.client = client if client != None else AzureOpenAI(
             azure_endpoint=os.getenv(f'{model}_ENDPOINT'),  
             api_version='2024-05-01-preview',
-            api_key=os.getenv(f'{model}_API_KEY')
+            api_key=os.getenv(f'{model}_API_KEY'),
+            max_retries=0
         )
         self.deployment_name = os.getenv(f'{model}_DEPLOYMENT_NAME')
         self.token_limit = token_limit
+        self.skip_cache_reads = False
+
+    @contextlib.contextmanager
+    def refreshing_cache(self):
+        # calls made inside the block skip cached outputs and overwrite them, e.g. when rerunning an instance
+        # whose cached outputs made it fail
+        previous = self.skip_cache_reads
+        self.skip_cache_reads = True
+        try:
+            yield
+        finally:
+            self.skip_cache_reads = previous
 
-    def prompt_model(self, prompt, num_tries=0, max_tries=3):
+    def prompt_model(self, prompt, num_tries=0, max_tries=6, tag=None, retry_reason=None, json_mode=False, monitor=None):
 
+        # outside the try, so running out of budget is never retried
+        reservation = self.call_log.check_budget(prompt) if self.call_log != None else None
+
+        start = time.time()
         try:
             messages = [{"role": "user", "content": prompt}]
-            response = self.client.chat.completions.create(
-                model=self.deployment_name, 
-                messages=messages,
-                temperature=self.temp
-            )
+            if self.stream:
+                output, usage, ttft, tokens_per_sec = self.stream_completion(prompt, messages, json_mode, monitor)
+                if self.call_log != None:
+                    self.call_log.record(tag, time.time() - start, usage, retry_reason, ttft=ttft, tokens_per_sec=tokens_per_sec, reservation=reservation)
+                return output
+            response = self.request_completion(messages, json_mode)
+            if self.call_log != None:
+                self.call_log.record(tag, time.time() - start, response.usage, retry_reason, reservation=reservation)
             return response.choices[0].message.content
+        except StreamAborted as e:
+            # the request itself worked, so the caller decides how to retry
+            if self.call_log != None:
+                self.call_log.record(tag, time.time() - start, e.usage, retry_reason, f'StreamAborted: {e}', ttft=e.ttft, tokens_per_sec=e.tokens_per_sec, reservation=reservation)
+            raise e
         except Exception as e:
+            if self.call_log != None:
+                self.call_log.record(tag, time.time() - start, None, retry_reason, type(e).__name__, reservation=reservation)
             if num_tries == max_tries - 1:
                 raise e 
-            return self.prompt_model(prompt, num_tries+1, max_tries)
+            retry_after = get_retry_after(e)
+            delay = retry_after if retry_after != None else backoff_delay(num_tries)
+            if self.rate_limiter != None and is_rate_limit_error(e):
+                self.rate_limiter.pause(delay)
+            print(f'Request failed ({type(e).__name__}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+            return self.prompt_model(prompt, num_tries+1, max_tries, tag, f'api error: {type(e).__name__}', json_mode, monitor)
+
+    def request_completion(self, messages, json_mode=False, stream=False):
+        if self.rate_limiter != None:
+            self.rate_limiter.acquire(messages)
+        # the 2024-05-01-preview API has JSON mode but not json_schema, so the schema itself is checked locally
+        extra_args = {'response_format': {'type': 'json_object'}} if json_mode else {}
+        if stream:
+            extra_args['stream'] = True
+        return self.client.chat.completions.create(
+            model=self.deployment_name, 
+            messages=messages,
+            temperature=self.temp,
+            **extra_args
+        )
+
+    def stream_completion(self, prompt, messages, json_mode=False, monitor=None):
+        start = time.time()
+        stream = self.request_completion(messages, json_mode, stream=True)
+        pieces = []
+        usage = None
+        ttft = None
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) != None:
+                usage = chunk.usage
+            # Azure sends content filter results as chunks without choices or content
+            if len(chunk.choices) == 0 or chunk.choices[0].delta.content == None:
+                continue
+            if ttft == None:
+                ttft = time.time() - start
+            pieces.append(chunk.choices[0].delta.content)
+            reason = monitor.feed(pieces[-1]) if monitor != None else None
+            if reason != None:
+                stream.close()
+                raise StreamAborted(reason, *self.stream_stats(prompt, pieces, usage, start, ttft))
+        return (''.join(pieces), *self.stream_stats(prompt, pieces, usage, start, ttft))
+
+    def stream_stats(self, prompt, pieces, usage, start, ttft):
+        # each content chunk is one token; usage is only in the stream on API versions with stream_options, so count it otherwise
+        if usage == None:
+            usage = SimpleNamespace(prompt_tokens=count_tokens(prompt), completion_tokens=len(pieces), prompt_tokens_details=None)
+        generation_time = time.time() - start - ttft if ttft != None else 0.0
+        tokens_per_sec = len(pieces) / generation_time if generation_time > 0 else None
+        return usage, ttft, tokens_per_sec
+
+    def submit(self, fn, *args):
+        # runs inline; ConcurrentLLM overrides this to run on its thread pool
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def generate(self, prompt, labels=[], num_tries=0, max_tries=5, read_cache=True, tag=None, retry_reason=None, schema=None):
+        if not self.json_mode:
+            schema = None
+        if self.cache == None:
+            return self.generate_uncached(prompt, labels, num_tries, max_tries, tag, retry_reason, schema)
 
-    def generate(self, prompt, labels=[], num_tries=0, max_tries=5):
+        # read_cache=False still refreshes the entry, so callers can retry past a bad cached output
+        cache_key = self.cache.make_key(self.model, self.deployment_name, self.temp, prompt, labels)
+        cached_out = self.cache.get(cache_key) if read_cache and not self.skip_cache_reads else None
+        # an entry cached before json_mode was turned on may not fit the schema; regenerate it rather than repair it
+        if cached_out != None and schema != None and len(validate(cached_out, schema)) > 0:
+            cached_out = None
+        if cached_out != None:
+            if self.call_log != None:
+                self.call_log.record(tag, 0.0, None, retry_reason, cached=True)
+            return cached_out
+        parse_out = self.generate_uncached(prompt, labels, num_tries, max_tries, tag, retry_reason, schema)
+        self.cache.set(cache_key, parse_out)
+        return parse_out
+
+    def generate_uncached(self, prompt, labels=[], num_tries=0, max_tries=5, tag=None, retry_reason=None, schema=None):
         if num_tries == max_tries:
             return None
 
-        output = self.prompt_model(prompt)
+        if schema != None:
+            try:
+                output = self.prompt_model(prompt, tag=tag, retry_reason=retry_reason, json_mode=True, monitor=JSONStreamMonitor(schema))
+            except StreamAborted as e:
+                print("Stream aborted:", e)
+                return self.generate_uncached(prompt, labels, num_tries+1, max_tries, tag, f'stream: {e}', schema)
+            parse_out = self.repair_json_out(output, schema, tag)
+            # only re-send the whole prompt if the repairs could not fix the output
+            if parse_out == None:
+                parse_out = self.generate_uncached(prompt, labels, num_tries+1, max_tries, tag, 'parse: repair failed', schema)
+            return parse_out
+
+        output = self.prompt_model(prompt, tag=tag, retry_reason=retry_reason)
         #print(output)
         if labels == None or len(labels) == 0:
             return output
@@ -44,9 +185,31 @@ class LLM():
         
         if parse_out == None:
             print("Retrying:", output)
-            parse_out = self.generate(prompt, labels, num_tries+1, max_tries)
+            parse_out = self.generate_uncached(prompt, labels, num_tries+1, max_tries, tag, 'parse: missing labels')
         return parse_out
 
+    def repair_json_out(self, output, schema, tag=None):
+        # each repair call only carries the bad output and its problems, not the (possibly 100k token) prompt
+        for num_repairs in range(self.max_repairs + 1):
+            try:
+                result = json.loads(output)
+                parse_out = {k.lower().replace('_', ' ').replace(':', ''): v for k, v in result.items()} if type(result) == dict else result
+            except Exception as e:
+                parse_out = None
+            errors = validate(parse_out, schema) if parse_out != None else ['the output is not valid JSON']
+            if len(errors) == 0:
+                return parse_out
+            if num_repairs == self.max_repairs:
+                break
+
+            print("Repairing:", errors)
+            prompt = f"The following JSON output does not have the required format:\n{output}"
+            prompt += f"\n\nProblems:\n" + "\n".join(['- ' + error for error in errors])
+            prompt += f"\n\nRewrite it as a JSON dictionary with the keys {describe(schema)}. "
+            prompt += f"Keep the content of the original output and only fix the format."
+            output = self.prompt_model(prompt, tag=tag, retry_reason=f'repair: {errors[0]}', json_mode=True)
+        return None
+
     def parse_json_out(self, output, labels):
     
         for k in labels:
@@ -78,4 +241,27 @@ class LLM():
                 result = {match[0].lower().replace('_', ' '): match[1] for match in matches}
                 return result
 
-        return None
\ No newline at end of file
+        return None
+
+""" LLM that fans calls out over a thread pool, with a cap on requests in flight """
+class ConcurrentLLM(LLM):
+    def __init__(self, model, temp, token_limit, cache=None, max_in_flight=8, rate_limiter=None, call_log=None, client=None, json_mode=False, max_repairs=2, stream=False):
+        super().__init__(model, temp, token_limit, cache, rate_limiter, call_log, client, json_mode, max_repairs, stream)
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def stream_completion(self, prompt, messages, json_mode=False, monitor=None):
+        # a streamed request stays in flight until its last chunk, not just until the stream opens
+        with self.in_flight:
+            return super().stream_completion(prompt, messages, json_mode, monitor)
+
+    def request_completion(self, messages, json_mode=False, stream=False):
+        if stream:
+            return super().request_completion(messages, json_mode, stream)
+        with self.in_flight:
+            return super().request_completion(messages, json_mode, stream)
+
+    def submit(self, fn, *args):
+        # submitted work must not block on other submitted work, or the pool can deadlock
+        return self.executor.submit(fn, *args)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+""" On-disk cache of parsed LLM outputs, keyed on everything that determines a response """
+class ResponseCache():
+
+    def __init__(self, path, max_entries=200000, bypass=False, evict_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.bypass = bypass
+        # counting the entries is a table scan, and other processes may share the file, so the size bound is
+        # checked every evict_every inserts rather than on each one
+        self.evict_every = evict_every
+        self.num_sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.conn.commit()
+
+    def make_key(self, model, deployment_name, temp, prompt, labels):
+        if labels != None and type(labels) != str:
+            labels = list(labels)
+        key_data = json.dumps([model, deployment_name, temp, prompt, labels], ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        if self.bypass or value == None:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, value, last_access) VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+            self.num_sets += 1
+            if self.num_sets % self.evict_every == 0:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # drop the least recently used entries once we are over the size bound
+        num_entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if num_entries <= self.max_entries:
+            return
+        self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)', (num_entries - self.max_entries,))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit rate': self.hits / total if total > 0 else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
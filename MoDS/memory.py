@@ -1,34 +1,117 @@
+import array
 import re
+import sys
+
+LABELS = ['no', 'yes']
+LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+
+class FactTable:
+
+    """ The facts of one discussion point, stored as columns: interned fact strings, label codes and document numbers """
+    __slots__ = ['facts', 'labels', 'doc_nums']
+
+    def __init__(self, facts=None, labels=None, doc_nums=None):
+        self.facts = facts if facts != None else []
+        self.labels = labels if labels != None else array.array('b')
+        self.doc_nums = doc_nums if doc_nums != None else array.array('i')
+
+    def extend(self, facts, labels, doc_nums):
+        # variants and points repeat the same speaker facts, so equal strings are stored once
+        self.facts.extend(sys.intern(fact) if type(fact) == str else fact for fact in facts)
+        self.labels.extend(LABEL_CODES[label] for label in labels)
+        if type(self.doc_nums) == array.array and not all(type(doc_num) == int for doc_num in doc_nums):
+            # citations parsed from the facts are strings, which the int array cannot hold
+            self.doc_nums = list(self.doc_nums)
+        self.doc_nums.extend(doc_nums)
+
+    def rows(self):
+        return zip(self.facts, (LABELS[code] for code in self.labels), self.doc_nums)
+
+    def copy(self):
+        return FactTable(list(self.facts), array.array('b', self.labels), self.doc_nums[:])
+
+    def __getitem__(self, key):
+        # the {'facts': [...], 'labels': [...], 'doc_nums': [...]} view memories used to store
+        if key == 'facts':
+            return self.facts
+        if key == 'labels':
+            return [LABELS[code] for code in self.labels]
+        if key == 'doc_nums':
+            return list(self.doc_nums)
+        raise KeyError(key)
+
+    def __reduce__(self):
+        # positional state, so a pickle holds no slot names per point
+        return (FactTable, (self.facts, self.labels, self.doc_nums))
+
+    @staticmethod
+    def from_dict(facts):
+        table = FactTable()
+        table.extend(facts['facts'], facts['labels'], facts['doc_nums'])
+        return table
 
 class Memory:
 
     """ A class that manages the discussion """
+    __slots__ = ['query', 'topic_speakers', 'topics', 'facts', 'fact_index', 'rounds', 'shared']
+
     def __init__(self, query):
         self.query = query
         self.topic_speakers = []
         self.topics = []
+        # one FactTable per point
         self.facts = []
+        # per point, {doc_num: {'yes': [facts], 'no': [facts]}}, filled as facts are added
+        self.fact_index = []
         self.rounds = []
+        # lists still shared with a fork, copied before they are first changed
+        self.shared = set()
+
+    def fork(self):
+        # a copy for another variant that shares every list with this memory until either side changes it
+        fork = Memory.__new__(Memory)
+        fork.query = self.query
+        fork.topic_speakers = self.topic_speakers
+        fork.topics = self.topics
+        fork.facts = self.facts
+        fork.rounds = self.rounds
+        # the index is derived, so the fork rebuilds its own on first use
+        fork.fact_index = []
+        fork.shared = {'topic_speakers', 'topics', 'facts', 'rounds'}
+        self.shared = set(fork.shared)
+        return fork
+
+    def own(self, name):
+        if name in self.shared:
+            value = getattr(self, name)
+            setattr(self, name, [table.copy() for table in value] if name == 'facts' else list(value))
+            self.shared.discard(name)
+        return getattr(self, name)
 
     def set_topics(self, topic_data):
         topic_data = dict(sorted(topic_data.items()))
+        topics = self.own('topics')
         for _, v in topic_data.items():
-            self.topics.append(v)
+            topics.append(v)
 
     def update_topics(self, topics):
         self.topics = topics
         self.topic_speakers = []
         self.facts = []
+        self.fact_index = []
         self.rounds = []
+        self.shared = set()
 
     def get_topics(self):
         return self.topics
         
     def initialize_topic(self):
-        self.facts.append({'facts': [], 'labels': [], 'doc_nums': []})
+        self.build_fact_index()
+        self.own('facts').append(FactTable())
+        self.fact_index.append(dict())
 
     def add_selected_speaker_info(self, speaker_info):
-        self.topic_speakers.append(speaker_info)
+        self.own('topic_speakers').append(speaker_info)
 
     def get_speaker_rationale_pairs(self):
         speaker_info = self.topic_speakers[-1]
@@ -43,10 +126,8 @@ class Memory:
     def add_facts(self, fact_info, speaker_num):
         yes_facts, no_facts = fact_info['yes facts'], fact_info['no facts']
         num_facts = len(yes_facts) + len(no_facts)
-        
-        self.facts[-1]['facts'].extend(yes_facts + no_facts)
-        self.facts[-1]['labels'].extend(['yes' for _ in yes_facts] + ['no' for _ in no_facts])
-        self.facts[-1]['doc_nums'].extend([speaker_num for _ in range(num_facts)])
+        self.index_facts(yes_facts + no_facts, ['yes' for _ in yes_facts] + ['no' for _ in no_facts], [speaker_num for _ in range(num_facts)])
+        self.own('facts')[-1].extend(yes_facts + no_facts, ['yes' for _ in yes_facts] + ['no' for _ in no_facts], [speaker_num for _ in range(num_facts)])
 
     def add_facts_citation(self, fact_info):
         yes_facts, no_facts = fact_info['yes facts'], fact_info['no facts']
@@ -59,9 +140,40 @@ class Memory:
             cites.append(re.findall(pattern, fact)[0])
             clean_facts.append(re.sub(pattern, '', fact).replace(' .', '.'))
 
-        self.facts[-1]['facts'].extend(clean_facts)
-        self.facts[-1]['labels'].extend(['yes' for _ in yes_facts] + ['no' for _ in no_facts])
-        self.facts[-1]['doc_nums'].extend(cites)
+        self.index_facts(clean_facts, ['yes' for _ in yes_facts] + ['no' for _ in no_facts], cites)
+        self.own('facts')[-1].extend(clean_facts, ['yes' for _ in yes_facts] + ['no' for _ in no_facts], cites)
+
+    def build_fact_index(self):
+        # forks and unpickled memories build the index from their fact tables on first use
+        if len(self.fact_index) == len(self.facts):
+            return
+        self.fact_index = []
+        for facts in self.facts:
+            self.fact_index.append(dict())
+            for fact, label, doc_num in facts.rows():
+                self.fact_index[-1].setdefault(doc_num, {'yes': [], 'no': []})[label].append(fact)
+
+    def index_facts(self, facts, labels, doc_nums):
+        self.build_fact_index()
+        for fact, label, doc_num in zip(facts, labels, doc_nums):
+            self.fact_index[-1].setdefault(doc_num, {'yes': [], 'no': []})[label].append(fact)
+
+    def get_fact_groups(self, idx):
+        # facts of point idx bucketed by document and label, so renderers make one pass instead of one per document
+        self.build_fact_index()
+        return self.fact_index[idx]
+
+    def __getstate__(self):
+        # the fact index is left out and rebuilt on first use, so pickles only hold the fact tables
+        return (self.query, self.topics, self.topic_speakers, self.facts, self.rounds)
+
+    def __setstate__(self, state):
+        if type(state) == dict:
+            # memories pickled before the fact tables, with a __dict__ of fact dicts
+            state = (state['query'], state['topics'], state['topic_speakers'], [FactTable.from_dict(facts) for facts in state['facts']], state.get('rounds', []))
+        self.query, self.topics, self.topic_speakers, self.facts, self.rounds = state
+        self.fact_index = []
+        self.shared = set()
 
     def print(self):
 
@@ -79,4 +191,4 @@ class Memory:
             out += f'\n\nTopic: {topic}'
             out += f'\nFacts:\n{fact_text}'
 
-        return out
\ No newline at end of file
+        return out
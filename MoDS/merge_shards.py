@@ -0,0 +1,32 @@
+import argparse
+import pickle
+from sharding import merge_shards
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Stitch the shard outputs of run_mods.py or the summarize scripts back into one pickle')
+    parser.add_argument('--shards', nargs='+', type=str, required=True, help='Shard pickles to merge (e.g. ..._shard0-of-4.pkl ..._shard3-of-4.pkl)')
+    parser.add_argument('--out', type=str, required=True, help='Path of the merged pickle')
+    parser.add_argument('--allow_missing', type=str, default="False", help='Write the merged pickle even if shards or instances are missing?')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+
+    merged, missing_shards, missing = merge_shards(args.shards)
+
+    if len(missing_shards) > 0:
+        print('Missing shards:', missing_shards)
+    for ds_name, idxs in missing.items():
+        print(f'{ds_name}: {len(merged[ds_name]) - len(idxs)}/{len(merged[ds_name])} instances', f'(missing {idxs})' if len(idxs) > 0 else '')
+
+    has_missing = len(missing_shards) > 0 or any(len(idxs) > 0 for idxs in missing.values())
+    if has_missing and args.allow_missing != 'True':
+        print('Not writing', args.out, '(rerun the missing shards, or pass --allow_missing True)')
+        return
+
+    with open(args.out, 'wb') as handle:
+        pickle.dump(merged, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
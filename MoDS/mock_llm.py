@@ -0,0 +1,129 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+class MockAPIError(Exception):
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers={'retry-after': str(retry_after)} if retry_after != None else {})
+
+class MockRateLimitError(MockAPIError):
+    pass
+
+""" Deterministic local stand-in for the chat completions client, answering with JSON shaped like each prompt asks for """
+class MockClient():
+
+    def __init__(self, latency_mean=1.0, latency_sigma=0.5, failure_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=0, malformed_rate=0.0):
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.malformed_rate = malformed_rate
+        self.first_token_share = 0.2
+        self.prefix_hashes = set()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, model, messages, temperature, **kwargs):
+        prompt = messages[-1]['content']
+
+        # latency and injected failures come from one seeded stream, so a serial run is reproducible
+        with self.lock:
+            latency = self.rng.lognormvariate(0, self.latency_sigma) * self.latency_mean if self.latency_mean > 0 else 0.0
+            draw = self.rng.random()
+            malformed = self.rng.random() < self.malformed_rate
+        if kwargs.get('stream', False):
+            # errors still surface from create, like the real client; the latency is spread over the stream
+            if draw < self.rate_limit_rate + self.failure_rate:
+                time.sleep(latency * self.first_token_share)
+        else:
+            time.sleep(latency)
+        if draw < self.rate_limit_rate:
+            raise MockRateLimitError('Mock rate limit', 429, self.retry_after)
+        if draw < self.rate_limit_rate + self.failure_rate:
+            raise MockAPIError('Mock server error', 500)
+
+        out = self.answer(prompt)
+        if malformed and len(out) > 0:
+            # the usual ways a real model misses the format: a list given as a string, or a dropped key
+            key = sorted(out.keys())[0]
+            if type(out[key]) == list:
+                out[key] = ' '.join(str(v) for v in out[key])
+            else:
+                out.pop(key)
+        content = json.dumps(out)
+        prompt_tokens_details = SimpleNamespace(cached_tokens=self.cached_prefix_tokens(prompt))
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4, prompt_tokens_details=prompt_tokens_details)
+        if kwargs.get('stream', False):
+            return self.stream(content, latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def cached_prefix_tokens(self, prompt):
+        # like the provider cache: prefixes of at least 1024 tokens, matched in steps of 128 tokens (at 4 characters a token)
+        hasher = hashlib.sha256()
+        cached_chars = 0
+        end = 0
+        for boundary in range(4096, len(prompt) + 1, 512):
+            hasher.update(prompt[end:boundary].encode('utf-8'))
+            end = boundary
+            prefix_hash = hasher.copy().hexdigest()
+            with self.lock:
+                if prefix_hash in self.prefix_hashes:
+                    cached_chars = boundary
+                else:
+                    self.prefix_hashes.add(prefix_hash)
+        return cached_chars // 4
+
+    def stream(self, content, latency):
+        # one chunk per 4 characters, the usual size of a token
+        pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+        time.sleep(latency * self.first_token_share)
+        for piece in pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+            time.sleep(latency * (1 - self.first_token_share) / len(pieces))
+
+    def answer(self, prompt):
+        # content only depends on the prompt, so identical prompts always get identical answers
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+        doc_nums = sorted(set(int(n) for n in re.findall(r'Document (\d+)', prompt, flags=re.IGNORECASE)))
+        keys = re.findall(r'"([^"]+)"', prompt[prompt.rfind('JSON dictionary'):]) if 'JSON dictionary' in prompt else []
+
+        out = dict()
+        if '"yes facts"' in prompt:
+            out['discussion point'] = f'Mock point {rng.randint(1, 100)}'
+            out['yes facts'] = [f'Mock yes fact {rng.randint(1, 1000)}.' for _ in range(rng.randint(0, 3))]
+            out['no facts'] = [f'Mock no fact {rng.randint(1, 1000)}.' for _ in range(rng.randint(0, 3))]
+            return out
+        if '"relevant documents"' in prompt:
+            rel_docs = sorted(rng.sample(doc_nums, rng.randint(1, len(doc_nums)))) if len(doc_nums) > 0 else []
+            out['relevant documents'] = rel_docs
+            for doc_num in rel_docs:
+                if 'document n question' in prompt.lower():
+                    out[f'document {doc_num} question'] = f'Mock question {doc_num}?'
+                if 'document n rationale' in prompt.lower():
+                    out[f'document {doc_num} rationale'] = f'Mock rationale {doc_num}.'
+            return out
+        if '"label"' in prompt:
+            return {'label': rng.choice(['opposing', 'not opposing', 'unanswerable']), 'reasoning': 'Mock reasoning.'}
+
+        for key in keys:
+            if key.startswith('discussion point'):
+                out[key] = f'Mock point {rng.randint(1, 100)}'
+            elif key in ['questions', 'important points', 'other points']:
+                out[key] = [f'Mock {key} {i}' for i in range(3)]
+            else:
+                out[key] = f'Mock {key} [{rng.choice(doc_nums) if len(doc_nums) > 0 else 1}].'
+        return out
+
+def build_client(args):
+    # the client for the --backend flag of the scripts: the mock, or None for the Azure deployment
+    if args.backend == 'mock':
+        return MockClient(args.mock_latency, 0.5, args.mock_failure_rate, args.mock_rate_limit_rate)
+    return None
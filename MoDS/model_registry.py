@@ -0,0 +1,27 @@
+from colbert.modeling.checkpoint import Checkpoint
+from colbert.infra import ColBERTConfig
+import threading
+
+""" Process-level registry of loaded ColBERT checkpoints, so every Retriever shares one encoder """
+class ModelRegistry():
+
+    def __init__(self):
+        self.checkpoints = dict()
+        self.lock = threading.Lock()
+
+    def get_checkpoint(self, colbert_model_name, doc_maxlen, query_maxlen, nbits):
+        key = (colbert_model_name, doc_maxlen, query_maxlen, nbits)
+        with self.lock:
+            if key not in self.checkpoints:
+                config = ColBERTConfig(doc_maxlen=doc_maxlen, query_maxlen=query_maxlen, nbits=nbits, kmeans_niters=8)
+                self.checkpoints[key] = Checkpoint(colbert_model_name, colbert_config=config, verbose=0)
+            return self.checkpoints[key]
+
+    def release(self, colbert_model_name=None):
+        # drops one model (every config of it) or, with no name, all of them
+        with self.lock:
+            for key in list(self.checkpoints.keys()):
+                if colbert_model_name == None or key[0] == colbert_model_name:
+                    del self.checkpoints[key]
+
+registry = ModelRegistry()
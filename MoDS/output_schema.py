@@ -0,0 +1,68 @@
+""" Expected shapes of the structured LLM outputs, so a bad output can be caught and repaired instead of regenerated """
+
+# values are str, int, or a one-element list for a list of that type;
+# a key containing {} is required once for every number in "relevant documents"
+SPEAKER_FACTS = {'discussion point': str, 'yes facts': [str], 'no facts': [str]}
+RELEVANT_DOCUMENTS = {'relevant documents': [int]}
+RELEVANT_DOCUMENTS_QUESTIONS = {'relevant documents': [int], 'document {} question': str}
+RELEVANT_DOCUMENTS_RATIONALES = {'relevant documents': [int], 'document {} rationale': str}
+POINT_SUMMARY = {'discussion point': str, 'summary': str}
+
+def discussion_points_schema(num_points):
+    return {f'discussion point {idx + 1}': str for idx in range(num_points)}
+
+def outline_summary_schema(num_points):
+    schema = dict()
+    for idx in range(num_points):
+        schema[f'discussion point {idx + 1}'] = str
+        schema[f'summary {idx + 1}'] = str
+    return schema
+
+def type_name(value_type, plural=False):
+    if type(value_type) == list:
+        return f'a list of {type_name(value_type[0], True)}'
+    if plural:
+        return {str: 'strings', int: 'integers'}[value_type]
+    return {str: 'a string', int: 'an integer'}[value_type]
+
+def matches_type(value, value_type):
+    if type(value_type) == list:
+        return type(value) == list and all(matches_type(v, value_type[0]) for v in value)
+    # bool is an int subclass, but never a valid document number
+    return type(value) == value_type
+
+def expand_keys(parsed_out, schema):
+    keys = dict()
+    for key, value_type in schema.items():
+        if '{}' not in key:
+            keys[key] = value_type
+            continue
+        rel_docs = parsed_out.get('relevant documents', [])
+        for doc_num in rel_docs if type(rel_docs) == list else []:
+            keys[key.format(doc_num)] = value_type
+    return keys
+
+def validate(parsed_out, schema):
+    # returns the list of problems, empty when the output is valid
+    if type(parsed_out) != dict:
+        return ['the output is not a JSON dictionary']
+
+    errors = []
+    for key, value_type in expand_keys(parsed_out, schema).items():
+        if key not in parsed_out:
+            errors.append(f'missing key "{key}"')
+        elif not matches_type(parsed_out[key], value_type):
+            errors.append(f'"{key}" must be {type_name(value_type)}, not {json_type_name(parsed_out[key])}')
+    return errors
+
+def json_type_name(value):
+    return {str: 'a string', int: 'an integer', float: 'a number', list: 'a list with other values', dict: 'a dictionary', bool: 'a boolean'}.get(type(value), 'null')
+
+def describe(schema):
+    parts = []
+    for key, value_type in schema.items():
+        if '{}' in key:
+            parts.append(f'"{key.format("N")}" ({type_name(value_type)}) for every document N in "relevant documents"')
+        else:
+            parts.append(f'"{key}" ({type_name(value_type)})')
+    return ', '.join(parts)
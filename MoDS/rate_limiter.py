@@ -0,0 +1,109 @@
+import fcntl
+import json
+import random
+import threading
+import time
+from token_counter import get_encoding
+
+""" Token bucket over requests and tokens per minute, optionally shared between processes through a state file """
+class RateLimiter():
+
+    def __init__(self, requests_per_minute, tokens_per_minute, state_path=None, expected_completion_tokens=500):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = state_path
+        self.expected_completion_tokens = expected_completion_tokens
+        self.lock = threading.Lock()
+        self.state = self.full_state()
+
+    def full_state(self):
+        return {'requests': self.requests_per_minute, 'tokens': self.tokens_per_minute, 'updated': time.time(), 'paused until': 0.0}
+
+    def estimate_tokens(self, messages):
+        return sum(len(get_encoding().encode(m['content'])) for m in messages) + self.expected_completion_tokens
+
+    def update_state(self, fn):
+        # runs fn on the bucket state under the thread lock, and the file lock when shared across processes
+        with self.lock:
+            if self.state_path == None:
+                return fn(self.state)
+            with open(self.state_path, 'a+') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    handle.seek(0)
+                    text = handle.read()
+                    state = json.loads(text) if text.strip() != '' else self.full_state()
+                    out = fn(state)
+                    handle.seek(0)
+                    handle.truncate()
+                    handle.write(json.dumps(state))
+                    handle.flush()
+                    return out
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        if self.requests_per_minute > 0:
+            state['requests'] = min(self.requests_per_minute, state['requests'] + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute > 0:
+            state['tokens'] = min(self.tokens_per_minute, state['tokens'] + elapsed * self.tokens_per_minute / 60)
+        state['updated'] = now
+
+    def try_acquire(self, state, num_tokens):
+        now = time.time()
+        self.refill(state, now)
+        if state['paused until'] > now:
+            return state['paused until'] - now
+
+        # a request bigger than the whole bucket only has to wait for a full bucket
+        if self.tokens_per_minute > 0:
+            num_tokens = min(num_tokens, self.tokens_per_minute)
+
+        wait = 0.0
+        if self.requests_per_minute > 0 and state['requests'] < 1:
+            wait = max(wait, (1 - state['requests']) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute > 0 and state['tokens'] < num_tokens:
+            wait = max(wait, (num_tokens - state['tokens']) * 60 / self.tokens_per_minute)
+        if wait > 0:
+            return wait
+
+        if self.requests_per_minute > 0:
+            state['requests'] -= 1
+        if self.tokens_per_minute > 0:
+            state['tokens'] -= num_tokens
+        return 0.0
+
+    def acquire(self, messages):
+        num_tokens = self.estimate_tokens(messages)
+        while True:
+            wait = self.update_state(lambda state: self.try_acquire(state, num_tokens))
+            if wait <= 0:
+                return
+            time.sleep(wait + random.uniform(0, 0.1))
+
+    def pause(self, seconds):
+        def set_pause(state):
+            state['paused until'] = max(state['paused until'], time.time() + seconds)
+        self.update_state(set_pause)
+
+def get_retry_after(e):
+    response = getattr(e, 'response', None)
+    if response == None:
+        return None
+    headers = getattr(response, 'headers', {})
+    try:
+        if headers.get('retry-after-ms') != None:
+            return float(headers.get('retry-after-ms')) / 1000
+        if headers.get('retry-after') != None:
+            return float(headers.get('retry-after'))
+    except ValueError:
+        return None
+    return None
+
+def is_rate_limit_error(e):
+    return getattr(e, 'status_code', None) == 429 or type(e).__name__ == 'RateLimitError'
+
+def backoff_delay(num_tries, base=1.0, cap=60.0):
+    # full jitter, so parallel workers do not retry in lockstep
+    return random.uniform(0, min(cap, base * 2 ** num_tries))
@@ -1,28 +1,189 @@
-from colbert.modeling.checkpoint import Checkpoint
-from colbert.infra import ColBERTConfig
+from embedding_store import EmbeddingStore, split_paragraphs
+from model_registry import registry
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import os
+import threading
 import torch
 
+""" LRU cache of query embeddings keyed by the query text """
+class QueryCache:
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.embeds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, query):
+        with self.lock:
+            if query not in self.embeds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.embeds.move_to_end(query)
+            return self.embeds[query]
+
+    def set(self, query, q_embed):
+        with self.lock:
+            self.embeds[query] = q_embed
+            self.embeds.move_to_end(query)
+            while len(self.embeds) > self.max_size:
+                self.embeds.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit rate': self.hits / total if total > 0 else 0.0}
+
+def set_encoding_threads(num_threads, num_processes=1):
+    # splits the cores between num_threads encoding threads in each of num_processes processes. The torch setting is
+    # process-wide, so it is made once at startup rather than around each encoding, under retrieval running in other threads
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // (num_threads * num_processes)))
+
+def encode_paragraphs(checkpoint, paragraphs, bsize=64, num_threads=1):
+    # sort by length so each batch pads to similar lengths, encode batches on num_threads workers
+    # (see set_encoding_threads for their intra-op threads), then scatter back to the input order
+    if len(paragraphs) == 0:
+        return []
+    order = sorted(range(len(paragraphs)), key=lambda i: len(paragraphs[i]))
+    batches = [order[i:i + bsize] for i in range(0, len(order), bsize)]
+
+    def encode_batch(batch):
+        return split_paragraphs(checkpoint.docFromText([paragraphs[i] for i in batch], bsize=len(batch))[0])
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        batch_embeds = list(executor.map(encode_batch, batches))
+
+    para_embeds = [None for _ in paragraphs]
+    for batch, embeds in zip(batches, batch_embeds):
+        for i, para_embed in zip(batch, embeds):
+            para_embeds[i] = para_embed
+    return para_embeds
+
+def quantize_int8(tokens):
+    # symmetric int8 codes with one fp16 scale per token vector
+    scales = tokens.float().abs().max(dim=1).values.clamp(min=1e-8) / 127
+    codes = torch.round(tokens.float() / scales.unsqueeze(1)).to(torch.int8)
+    return codes, scales.to(torch.float16)
+
 class Retriever:
 
-    def __init__(self, docs, doc_maxlen, query_maxlen, nbits, colbert_model_name):
+    def __init__(self, docs, doc_maxlen, query_maxlen, nbits, colbert_model_name, store=None, checkpoint=None, query_cache=None, bsize=64, num_threads=1, compress=False):
 
-        config = ColBERTConfig(doc_maxlen=doc_maxlen, query_maxlen=query_maxlen, nbits=nbits, kmeans_niters=8)
-        self.checkpoint = Checkpoint(colbert_model_name, colbert_config=config, verbose=0)
-        self.doc_embeds = [self.checkpoint.docFromText(docs_, bsize=8)[0].to('cpu') for docs_ in docs]
+        self.checkpoint = checkpoint if checkpoint != None else registry.get_checkpoint(colbert_model_name, doc_maxlen, query_maxlen, nbits)
+        self.query_cache = query_cache if query_cache != None else QueryCache()
         self.docs = docs
+        self.compress = compress
+        self.pack(*self.embed_docs(docs, store, colbert_model_name, doc_maxlen, bsize, num_threads))
+
+    def embed_docs(self, docs, store, colbert_model_name, doc_maxlen, bsize, num_threads):
+        # per document, a [num_tokens, dim] fp16 matrix of its paragraphs' tokens and the number of tokens of each paragraph;
+        # documents in the store are views of its memmap, so processes scoring them share its pages rather than copies
+        doc_embeds = [None for _ in docs]
+        for doc_num, docs_ in enumerate(docs):
+            if store != None:
+                key = EmbeddingStore.doc_key(docs_, colbert_model_name, doc_maxlen)
+                if store.contains(key):
+                    doc_embeds[doc_num] = store.get_doc(key)
+
+        # paragraphs of every document not in the store are encoded together, then split back per document
+        missing = [doc_num for doc_num, doc_embed in enumerate(doc_embeds) if doc_embed == None]
+        para_embeds = encode_paragraphs(self.checkpoint, [para for doc_num in missing for para in docs[doc_num]], bsize, num_threads)
+        start = 0
+        for doc_num in missing:
+            doc_para_embeds = para_embeds[start:start + len(docs[doc_num])]
+            doc_embeds[doc_num] = (torch.cat(doc_para_embeds).to(torch.float16), [para_embed.shape[0] for para_embed in doc_para_embeds])
+            start += len(docs[doc_num])
+        return doc_embeds, len(missing) < len(docs)
+
+    def pack(self, doc_embeds, stored):
+        # the paragraph of each token and token/paragraph offsets per document, so all paragraphs are scored in one matmul.
+        # Tokens are one flat [num_tokens, dim] matrix with a view per document, unless some documents are views of the
+        # store's memmap: those are left shared and only stacked for the duration of a batched matmul
+        para_lens = [para_len for _, doc_para_lens in doc_embeds for para_len in doc_para_lens]
+        self.doc_num_paras = [len(doc_para_lens) for _, doc_para_lens in doc_embeds]
+        self.para_offsets = np.concatenate([[0], np.cumsum(self.doc_num_paras, dtype=np.int64)]).tolist()
+        self.token_offsets = np.concatenate([[0], np.cumsum(para_lens, dtype=np.int64)])[self.para_offsets].tolist()
+        self.token_paras = torch.repeat_interleave(torch.arange(len(para_lens)), torch.tensor(para_lens, dtype=torch.long))
+
+        # where each paragraph's score goes in the -inf padded [num_docs, max_paras] layout of the segmented top-k
+        self.para_docs = torch.repeat_interleave(torch.arange(len(doc_embeds)), torch.tensor(self.doc_num_paras, dtype=torch.long))
+        self.para_in_doc = torch.arange(len(para_lens)) - torch.tensor(self.para_offsets[:-1], dtype=torch.long)[self.para_docs]
+
+        self.tokens, self.token_scales = None, None
+        if self.compress or not stored:
+            self.tokens = torch.cat([tokens for tokens, _ in doc_embeds])
+            if self.compress:
+                self.tokens, self.token_scales = quantize_int8(self.tokens)
+        self.doc_tokens = [self.tokens[start:end] for start, end in zip(self.token_offsets[:-1], self.token_offsets[1:])] if self.tokens != None else [tokens for tokens, _ in doc_embeds]
+        self.doc_token_scales = [self.token_scales[start:end] if self.compress else None for start, end in zip(self.token_offsets[:-1], self.token_offsets[1:])]
+
+    def encode_queries(self, queries):
+        # every distinct query missing from the cache is encoded in one forward pass
+        q_embeds = {query: self.query_cache.get(query) for query in dict.fromkeys(queries)}
+        missing = [query for query, q_embed in q_embeds.items() if q_embed == None]
+        if len(missing) > 0:
+            new_embeds = self.checkpoint.queryFromText(missing, bsize=max(8, len(missing))).to('cpu').to(torch.float16)
+            for query, q_embed in zip(missing, new_embeds):
+                self.query_cache.set(query, q_embed)
+                q_embeds[query] = q_embed
+        return [q_embeds[query] for query in queries]
+
+    def encode_query(self, query):
+        return self.encode_queries([query])[0]
+
+    def memory_bytes(self):
+        num_bytes = sum(tokens.numel() * tokens.element_size() for tokens in self.doc_tokens)
+        if self.compress:
+            num_bytes += self.token_scales.numel() * self.token_scales.element_size()
+        return num_bytes
+
+    def token_sims(self, q_embed, tokens, scales=None, chunk_size=65536):
+        if scales == None:
+            return torch.matmul(tokens, q_embed.T).float()
+
+        # int8 codes are decompressed a chunk at a time, so the full fp32 matrix is never materialized
+        q_embed = q_embed.float()
+        sims = []
+        for start in range(0, tokens.shape[0], chunk_size):
+            end = min(start + chunk_size, tokens.shape[0])
+            sims.append(torch.matmul(tokens[start:end].float(), q_embed.T) * scales[start:end].float().unsqueeze(1))
+        return torch.cat(sims) if len(sims) > 0 else torch.zeros((0, q_embed.shape[0]))
+
+    def max_sim(self, sims, token_paras, num_paras):
+        # MaxSim over a block of paragraphs: max over each paragraph's tokens, summed over query tokens
+        max_sims = torch.full((num_paras, sims.shape[1]), float('-inf')).scatter_reduce(0, token_paras.unsqueeze(1).expand_as(sims), sims, reduce='amax')
+        return max_sims.sum(dim=1)
+
+    def score_paragraphs(self, q_embed, doc_num):
+        token_start, token_end = self.token_offsets[doc_num], self.token_offsets[doc_num + 1]
+        sims = self.token_sims(q_embed, self.doc_tokens[doc_num], self.doc_token_scales[doc_num])
+        return self.max_sim(sims, self.token_paras[token_start:token_end] - self.para_offsets[doc_num], self.doc_num_paras[doc_num])
 
     def get_doc_candidates(self, query, top_k):
-        q_embed = self.checkpoint.queryFromText([query], bsize=8)[0].to('cpu').to(torch.float16)
-        final_scores = [torch.sum(torch.max(torch.matmul(q_embed.squeeze(0), doc_embed.transpose(1, 2)), dim=2)[0], dim=1) for doc_embed in self.doc_embeds]
-        para_idxs = [torch.topk(sublist, min(top_k, len(sublist))).indices.tolist() for sublist in final_scores]
-        paras = [[self.docs[i][idx] for idx in l] for i, l in enumerate(para_idxs)]
-        max_scores = np.array([sublist[para_idxs[i][0]].item() for i, sublist in enumerate(final_scores)])
-        return paras, max_scores
-
-    def retrieve(self, query, top_k, doc_num):
-        q_embed = self.checkpoint.queryFromText([query], bsize=8)[0].to('cpu').to(torch.float16)
-        final_scores = torch.sum(torch.max(torch.matmul(q_embed.squeeze(0), self.doc_embeds[doc_num].transpose(1, 2)), dim=2)[0], dim=1)
+        q_embed = self.encode_query(query)
+        num_docs, max_paras = len(self.doc_num_paras), max(self.doc_num_paras, default=0)
+        if max_paras == 0:
+            return [[] for _ in self.docs], np.full(num_docs, float('-inf'), dtype=np.float32)
+
+        tokens = self.tokens if self.tokens != None else torch.cat(self.doc_tokens)
+        para_scores = self.max_sim(self.token_sims(q_embed, tokens, self.token_scales), self.token_paras, self.para_offsets[-1])
+
+        # segmented top-k: lay the paragraph scores out as [num_docs, max_paras], padding with -inf
+        doc_scores = torch.full((num_docs, max_paras), float('-inf'))
+        doc_scores[self.para_docs, self.para_in_doc] = para_scores
+        top_scores, top_idxs = torch.topk(doc_scores, min(top_k, max_paras), dim=1)
+
+        top_idxs = top_idxs.tolist()
+        paras = [[self.docs[doc_num][idx] for idx in top_idxs[doc_num][:min(top_k, num_paras)]] for doc_num, num_paras in enumerate(self.doc_num_paras)]
+        return paras, top_scores[:, 0].numpy()
+
+    def retrieve(self, query, top_k, doc_num, q_embed=None):
+        if q_embed == None:
+            q_embed = self.encode_query(query)
+        final_scores = self.score_paragraphs(q_embed, doc_num)
         para_idxs = torch.topk(final_scores, min(top_k, len(final_scores))).indices.tolist()
         paras = [self.docs[doc_num][idx] for idx in para_idxs]
-        return paras
\ No newline at end of file
+        return paras
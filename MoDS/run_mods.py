@@ -2,18 +2,29 @@ import argparse
 import tqdm
 from memory import Memory
 from data_loader import ConflictDataset
-from llm import LLM
+from llm import ConcurrentLLM
+from llm_cache import ResponseCache
+from rate_limiter import RateLimiter
+from call_log import CallLog, BudgetExceeded, reset_call_log, summarize_call_log
+from mock_llm import build_client
 from moderator import Moderator
 from speaker import Speaker
-from retriever import Retriever
+from retriever import QueryCache, Retriever, set_encoding_threads
+from embedding_store import EmbeddingStore
+from model_registry import registry
+from journal import Journal
+from shared_calls import SharedCalls
+from sharding import parse_shard, shard_range, shard_suffix, save_shard
 import pickle
-import copy
+import multiprocessing
 import traceback
 
 from dotenv import load_dotenv, find_dotenv
 env_path = ''
 load_dotenv(env_path)
 
+DATASETS = ['Debatepedia', 'ConflictingQA']
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Run the round robin discussion')
     parser.add_argument('--run_name', type=str, default="default_run", help='Run name to identify the inference type.')
@@ -25,101 +36,230 @@ def parse_args():
     parser.add_argument('--use_rationale', nargs='+', type=str, default=["False"], help='Use the CoT rationale? Enter multiple values separated by spaces.')
     parser.add_argument('--use_subtopic_retrieval', type=str, default="True", help='Use the subtopic for retrieval in round two?')
     parser.add_argument('--select_agents', type=str, default="True", help='Should the moderator select a subset of agents?')
+    parser.add_argument('--cache_path', type=str, default="./llm_cache.db", help='SQLite file for the LLM response cache')
+    parser.add_argument('--cache_size', type=int, default=200000, help='Maximum number of cached LLM responses')
+    parser.add_argument('--bypass_cache', type=str, default="False", help='Skip the LLM response cache?')
+    parser.add_argument('--max_in_flight', type=int, default=8, help='Maximum number of concurrent LLM requests')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute allowed by the deployment (0 for no limit)')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute allowed by the deployment (0 for no limit)')
+    parser.add_argument('--rate_limit_path', type=str, default="", help='State file to share the rate limit across processes')
+    parser.add_argument('--embedding_store', type=str, default="", help='Directory of precomputed ColBERT embeddings (see build_embedding_store.py)')
+    parser.add_argument('--bsize', type=int, default=64, help='Batch size for encoding paragraphs missing from the embedding store')
+    parser.add_argument('--num_threads', type=int, default=1, help='Number of threads encoding paragraphs in each worker')
+    parser.add_argument('--compress_embeddings', type=str, default="False", help='Keep paragraph embeddings as int8 codes with per-vector scales?')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes running instances in parallel')
+    parser.add_argument('--resume', type=str, default="False", help='Skip instances already in the run journals?')
+    parser.add_argument('--compact_only', type=str, default="False", help='Only compact the run journals into the output pickles?')
+    parser.add_argument('--shard', type=str, default="0/1", help='Run only shard i of N ("i/N"); merge the shard outputs with merge_shards.py')
+    parser.add_argument('--call_log', type=str, default="calls.jsonl", help='JSONL file (under res_dir/run_name) logging every LLM call; empty to disable')
+    parser.add_argument('--usd_per_1k_prompt', type=float, default=0.0, help='Price per 1K prompt tokens, for cost accounting')
+    parser.add_argument('--usd_per_1k_completion', type=float, default=0.0, help='Price per 1K completion tokens, for cost accounting')
+    parser.add_argument('--max_calls', type=int, default=0, help='Abort once this run made this many LLM calls (0 for no limit); a resumed run starts counting again')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Abort before using more than this many tokens (0 for no limit)')
+    parser.add_argument('--max_usd', type=float, default=0.0, help='Abort before spending more than this many dollars (0 for no limit)')
+    parser.add_argument('--backend', type=str, default="azure", help='LLM backend: "azure", or "mock" for the offline stand-in')
+    parser.add_argument('--mock_latency', type=float, default=1.0, help='Mean latency in seconds of the mock backend')
+    parser.add_argument('--mock_failure_rate', type=float, default=0.0, help='Fraction of mock calls failing with a server error')
+    parser.add_argument('--mock_rate_limit_rate', type=float, default=0.0, help='Fraction of mock calls failing with a 429')
+    parser.add_argument('--json_mode', type=str, default="False", help='Request JSON outputs and repair ones not matching the expected schema?')
+    parser.add_argument('--stream', type=str, default="False", help='Stream completions, logging time-to-first-token and stopping bad JSON outputs early?')
     args = parser.parse_args()
     return args
 
-def mods(idx, ds, llm, num_topics, top_k, use_cot_list, use_rationale_list, use_point_for_retrieval, select_agents, num_tries=0, max_tries=5):
+def mods(idx, ds, llm, num_topics, top_k, use_cot_list, use_rationale_list, use_point_for_retrieval, select_agents, store=None, compress=False, bsize=64, num_threads=1, retriever_factory=Retriever, query_cache=None, shared_counts=None, num_tries=0, max_tries=5):
     
     try:
-        query, docs = ds.get_item(idx)
+        query, docs, doc_token_counts = ds.get_item(idx, True)
         print(f"{idx}) Query (try number {num_tries}):", query)
         base_memory = Memory(query)
-        retriever = Retriever(docs, 300, 64, 8, 'colbert-ir/colbertv2.0')
+        retriever = retriever_factory(docs, 300, 64, 8, 'colbert-ir/colbertv2.0', store, bsize=bsize, num_threads=num_threads, compress=compress, query_cache=query_cache)
         moderator = Moderator(retriever, llm)
-        speakers = [Speaker(retriever, llm, docs_, doc_num) for doc_num, docs_ in enumerate(docs)]
+        speakers = [Speaker(retriever, llm, docs_, doc_num, doc_token_counts[doc_num] if doc_token_counts != None else None) for doc_num, docs_ in enumerate(docs)]
 
         discussion_points = moderator.plan_discussion_points(query, num_topics, top_k)
         base_memory.set_topics(discussion_points)
 
-        memory_out = dict()
+        # every variant's calls go through one SharedCalls, so a call with the same prompt is made once and fanned out
+        variants = list(zip(use_cot_list, use_rationale_list))
+        shared = SharedCalls(llm)
+        memory_out = {variant: base_memory.fork() for variant in variants}
+        points = base_memory.get_topics()
 
-        # all CoT variations
-        for use_cot, use_rationale in zip(use_cot_list, use_rationale_list):
+        # classify relevant agents for every point at once; the prompt only depends on use_cot
+        if select_agents:
+            retriever.encode_queries(points if use_point_for_retrieval else [query])
+            mod_futures = {(use_cot, use_rationale): [shared.submit(('moderator.select', point, use_cot), moderator.select_speakers_for_point_question, query, point, top_k, use_cot, use_point_for_retrieval) for point in points] for use_cot, use_rationale in variants}
 
-            memory = copy.deepcopy(base_memory)
-            
-            # discussion points
-            for point in tqdm.tqdm(memory.get_topics()):
-                
-                # initialize the memory
-                memory.initialize_topic()
-                
-                # classify relevant agents
+        # discussion points
+        speaker_lists = dict()
+        for use_cot, use_rationale in variants:
+            memory = memory_out[(use_cot, use_rationale)]
+            speaker_lists[(use_cot, use_rationale)] = []
+            for point_idx, point in enumerate(points):
                 if select_agents:
-                    mod_selection = moderator.select_speakers_for_point_question(query, point, top_k, use_cot, use_point_for_retrieval)
-                    memory.add_selected_speaker_info(mod_selection)
-                
-                # speakers
+                    memory.add_selected_speaker_info(mod_futures[(use_cot, use_rationale)][point_idx].result())
                 speaker_list = memory.get_speaker_question_pairs() if select_agents else zip(list(range(len(docs))), [None for _ in docs])
-                for speaker_num, gen_question in speaker_list:
-                    speaker_out = speakers[speaker_num].speak_rag(query, top_k, point, gen_question if use_rationale else point)
-                    memory.add_facts(speaker_out, speaker_num)
+                speaker_lists[(use_cot, use_rationale)].append([(speaker_num, gen_question if use_rationale else point) for speaker_num, gen_question in speaker_list])
 
-            memory_out[(use_cot, use_rationale)] = memory
+        # encode every speaker search query in one pass before fanning out
+        retriever.encode_queries([search_query for point_lists in speaker_lists.values() for speaker_list in point_lists for _, search_query in speaker_list])
 
+        # speakers
+        speaker_futures = {variant: [[(speaker_num, shared.submit(('speaker.speak_rag', speaker_num, point, search_query), speakers[speaker_num].speak_rag, query, top_k, point, search_query)) for speaker_num, search_query in speaker_list] for point, speaker_list in zip(points, point_lists)] for variant, point_lists in speaker_lists.items()}
+
+        # collect facts in point and speaker order so each memory is deterministic
+        for variant in variants:
+            memory = memory_out[variant]
+            for point_futures in tqdm.tqdm(speaker_futures[variant]):
+                memory.initialize_topic()
+                for speaker_num, speaker_future in point_futures:
+                    memory.add_facts(speaker_future.result(), speaker_num)
+
+        # added up over the run by the caller and reported once, rather than per instance
+        if shared_counts != None:
+            shared_counts['requested'] += shared.num_requested
+            shared_counts['deduplicated'] += shared.num_deduplicated()
         return memory_out
 
+    except BudgetExceeded as e:
+        raise e
     except Exception as e:
         excep = traceback.format_exc()
         print("Overall Exception:", excep)
         if num_tries == max_tries - 1:
             return {k: str(excep) for k in zip(use_cot_list, use_rationale_list)}
-        return mods(idx, ds, llm, num_topics, top_k, use_cot_list, use_rationale_list, use_point_for_retrieval, select_agents, num_tries=num_tries+1, max_tries=max_tries)
-
-def save_checkpoint(outputs_dict, out_dict, ds_name, args, USE_POINT_RETRIEVAL, SELECT_AGENTS):
+        # the model is asked again rather than replaying the cached outputs of the failed try
+        with llm.refreshing_cache():
+            return mods(idx, ds, llm, num_topics, top_k, use_cot_list, use_rationale_list, use_point_for_retrieval, select_agents, store, compress, bsize, num_threads, retriever_factory, query_cache, shared_counts, num_tries=num_tries+1, max_tries=max_tries)
 
-    curr_outputs_dict = copy.deepcopy(outputs_dict)
-    curr_out_dict = copy.deepcopy(out_dict)
+def variant_path(args, use_cot, use_rationale):
+    USE_POINT_RETRIEVAL = args.use_subtopic_retrieval == 'True'
+    SELECT_AGENTS = args.select_agents == 'True'
+    return f'{args.res_dir}/{args.run_name}/mods_{use_cot}-CoT_{use_rationale}-Rationale_{USE_POINT_RETRIEVAL}-PointRetrieval_{SELECT_AGENTS}-Select'
 
-    for k, v in curr_outputs_dict.items():
-        curr_out_dict[k][ds_name] = v
+def call_log_path(args):
+    # per shard, like the journals, so starting one shard never resets another's log
+    shard_num, num_shards = parse_shard(args.shard)
+    suffix = shard_suffix(shard_num, num_shards) if num_shards > 1 else ''
+    return f'{args.res_dir}/{args.run_name}/{args.call_log.replace(".jsonl", "")}{suffix}.jsonl' if args.call_log != '' else None
 
-    for k, v in curr_out_dict.items():
+def compact_journals(journals, args, sizes):
+    shard_num, num_shards = parse_shard(args.shard)
+    for k, journal in journals.items():
         use_cot_, use_rationale_ = k
-        with open(f'{args.res_dir}/{args.run_name}/mods_{use_cot_}-CoT_{use_rationale_}-Rationale_{USE_POINT_RETRIEVAL}-PointRetrieval_{SELECT_AGENTS}-Select_TEMP.pkl', 'wb') as handle:
-            pickle.dump(v, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        # lets summarize_outlines.py, following the journal, know no more instances are coming
+        journal.finish(sizes)
+        if num_shards > 1:
+            save_shard(f'{variant_path(args, use_cot_, use_rationale_)}{shard_suffix(shard_num, num_shards)}.pkl', shard_num, num_shards, sizes, journal.outputs_by_index(DATASETS))
+            continue
+        with open(f'{variant_path(args, use_cot_, use_rationale_)}.pkl', 'wb') as handle:
+            pickle.dump(journal.compact(DATASETS, sizes), handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-def main(args):
+# per-process state, built once by init_worker in each pool worker (or in the main process when --workers 1)
+worker_state = dict()
+
+def build_llm(args):
+    cache = ResponseCache(args.cache_path, args.cache_size, args.bypass_cache == 'True')
+    rate_limiter = RateLimiter(args.rpm, args.tpm, args.rate_limit_path if args.rate_limit_path != '' else None) if args.rpm > 0 or args.tpm > 0 else None
+    # each worker process enforces an equal share of the budget, at least 1 so a small budget never becomes 0 (no limit)
+    max_calls = max(1, args.max_calls // args.workers) if args.max_calls > 0 else 0
+    max_tokens = max(1, args.max_tokens // args.workers) if args.max_tokens > 0 else 0
+    call_log = CallLog(call_log_path(args), args.usd_per_1k_prompt, args.usd_per_1k_completion, max_calls, max_tokens, args.max_usd / args.workers)
+    return ConcurrentLLM('GPT4', 0.0, 127000, cache, args.max_in_flight, rate_limiter, call_log, build_client(args), args.json_mode == 'True', 2, args.stream == 'True')
+
+def init_worker(args):
+    load_dotenv(env_path)
+    set_encoding_threads(args.num_threads, args.workers)
+    worker_state['args'] = args
+    worker_state['llm'] = build_llm(args)
+    worker_state['store'] = EmbeddingStore(args.embedding_store) if args.embedding_store != '' else None
+    # query embeddings are shared by the retrievers of every instance the worker runs, as all use one model
+    worker_state['query_cache'] = QueryCache()
+    worker_state['datasets'] = dict()
+
+def run_instance(job):
+    ds_name, idx = job
+    args = worker_state['args']
+    if ds_name not in worker_state['datasets']:
+        worker_state['datasets'][ds_name] = ConflictDataset(ds_name, 1)
+    ds = worker_state['datasets'][ds_name]
+    worker_state['llm'].call_log.instance = (ds_name, idx)
 
-    llm = LLM('GPT4', 0.0, 127000)
-    TOP_K = args.top_k
-    NUM_TOPICS = args.num_topics
-    NUM_TO_RUN = args.num_to_run
     USE_COT = [b == 'True' for b in args.use_cot]
     USE_RATIONALE = [b == 'True' for b in args.use_rationale]
     USE_POINT_RETRIEVAL = args.use_subtopic_retrieval == 'True'
     SELECT_AGENTS = args.select_agents == 'True'
+    shared_counts = {'requested': 0, 'deduplicated': 0}
+    query_cache = worker_state['query_cache']
+    hits, misses = query_cache.hits, query_cache.misses
+    mem_out = mods(idx, ds, worker_state['llm'], args.num_topics, args.top_k, USE_COT, USE_RATIONALE, USE_POINT_RETRIEVAL, SELECT_AGENTS, worker_state['store'], args.compress_embeddings == 'True', args.bsize, args.num_threads, query_cache=query_cache, shared_counts=shared_counts)
+    # this instance's lookups, so the main process can total them over the workers
+    return mem_out, shared_counts, {'hits': query_cache.hits - hits, 'misses': query_cache.misses - misses}
+
+def main(args):
+
+    NUM_TO_RUN = args.num_to_run
+    USE_COT = [b == 'True' for b in args.use_cot]
+    USE_RATIONALE = [b == 'True' for b in args.use_rationale]
+    shard_num, num_shards = parse_shard(args.shard)
+    sizes = {ds_name: NUM_TO_RUN if NUM_TO_RUN != 0 else ConflictDataset(ds_name, 1).length() for ds_name in DATASETS}
+
+    # one append-only journal per variant (and shard); without --resume a run starts from empty journals
+    suffix = shard_suffix(shard_num, num_shards) if num_shards > 1 else ''
+    journals = {(a, b): Journal(f'{variant_path(args, a, b)}{suffix}.journal', reset=args.resume != 'True' and args.compact_only != 'True') for a,b in zip(USE_COT, USE_RATIONALE)}
+    if args.compact_only == 'True':
+        compact_journals(journals, args, sizes)
+        return
+    # the call log, and so the run totals, only carries over from earlier runs under --resume
+    if args.call_log != '' and args.resume != 'True':
+        reset_call_log(call_log_path(args))
+
+    if args.workers > 1:
+        # workers have to share one quota, so give the rate limiter a state file if it has none
+        if (args.rpm > 0 or args.tpm > 0) and args.rate_limit_path == '':
+            args.rate_limit_path = f'{args.res_dir}/{args.run_name}/rate_limit.json'
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_worker, initargs=(args,))
+    else:
+        init_worker(args)
     
-    out_dict = {(a, b): dict() for a,b in zip(USE_COT, USE_RATIONALE)}
-    for ds_name in ['Debatepedia', 'ConflictingQA']:
-        ds = ConflictDataset(ds_name, 1)
-        outputs_dict = {(a, b): [] for a,b in zip(USE_COT, USE_RATIONALE)}
-
-        for idx in range(0, NUM_TO_RUN if NUM_TO_RUN != 0 else ds.length()):
-            mem_out = mods(idx, ds, llm, NUM_TOPICS, TOP_K, USE_COT, USE_RATIONALE, USE_POINT_RETRIEVAL, SELECT_AGENTS)
-            for k, v in mem_out.items():
-                outputs_dict[k].append(v)
-
-            if idx % 10 == 0:
-                save_checkpoint(outputs_dict, out_dict, ds_name, args, USE_POINT_RETRIEVAL, SELECT_AGENTS)
-        
-        for k, v in outputs_dict.items():
-            out_dict[k][ds_name] = v
-
-    for k, v in out_dict.items():
-        use_cot_, use_rationale_ = k
-        with open(f'{args.res_dir}/{args.run_name}/mods_{use_cot_}-CoT_{use_rationale_}-Rationale_{USE_POINT_RETRIEVAL}-PointRetrieval_{SELECT_AGENTS}-Select.pkl', 'wb') as handle:
-            pickle.dump(v, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    shared_counts = {'requested': 0, 'deduplicated': 0}
+    query_cache_counts = {'hits': 0, 'misses': 0}
+    try:
+        for ds_name in DATASETS:
+
+            # imap hands results back in index order, however the workers finish
+            jobs = [(ds_name, idx) for idx in range(*shard_range(sizes[ds_name], shard_num, num_shards))]
+            jobs = [job for job in jobs if not all(journal.is_completed(*job) for journal in journals.values())]
+            print(f'{ds_name}: {len(jobs)} instances to run')
+            results = pool.imap(run_instance, jobs) if args.workers > 1 else map(run_instance, jobs)
+            for (_, idx), (mem_out, instance_shared_counts, instance_query_cache_counts) in zip(jobs, results):
+                for k, v in mem_out.items():
+                    journals[k].append(ds_name, idx, v)
+                for k, v in instance_shared_counts.items():
+                    shared_counts[k] += v
+                for k, v in instance_query_cache_counts.items():
+                    query_cache_counts[k] += v
+    except BudgetExceeded as e:
+        # everything finished so far is journaled; rerun with --resume to continue, with a budget of its own
+        print('Stopping run:', e)
+        if args.workers > 1:
+            pool.terminate()
+
+    compact_journals(journals, args, sizes)
+    print(f"Shared {shared_counts['deduplicated']} of {shared_counts['requested']} moderator/speaker calls across variants")
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    else:
+        registry.release()
+        print('LLM cache:', worker_state['llm'].cache.stats())
+    # totalled over the workers, from the lookups of each instance
+    num_lookups = query_cache_counts['hits'] + query_cache_counts['misses']
+    print('Query cache:', {**query_cache_counts, 'hit rate': query_cache_counts['hits'] / num_lookups if num_lookups > 0 else 0.0})
+
+    if args.call_log != '':
+        print('LLM calls:', summarize_call_log(call_log_path(args), call_log_path(args).replace('.jsonl', '') + '_summary.csv'))
 
 if __name__ == "__main__":
     args = parse_args()
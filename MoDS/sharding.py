@@ -0,0 +1,44 @@
+import pickle
+
+""" Helpers for splitting a run into contiguous index shards and stitching the shard outputs back """
+
+def parse_shard(shard):
+    # "i/N", with shards numbered from 0
+    shard_num, num_shards = [int(x) for x in shard.split('/')]
+    assert 0 <= shard_num < num_shards, f"Invalid shard {shard}"
+    return shard_num, num_shards
+
+def shard_range(num_items, shard_num, num_shards):
+    return num_items * shard_num // num_shards, num_items * (shard_num + 1) // num_shards
+
+def shard_suffix(shard_num, num_shards):
+    return f'_shard{shard_num}-of-{num_shards}'
+
+def save_shard(path, shard_num, num_shards, sizes, outputs):
+    # sizes: {dataset: number of instances in the whole run}, outputs: {dataset: {idx: output}}
+    shard_data = {'shard': shard_num, 'num shards': num_shards, 'sizes': sizes, 'outputs': outputs}
+    with open(path, 'wb') as handle:
+        pickle.dump(shard_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+def merge_shards(paths):
+    # returns the usual {dataset: [output, ...]} layout, plus the missing shards and indices per dataset
+    shards = []
+    for path in paths:
+        with open(path, 'rb') as handle:
+            shards.append(pickle.load(handle))
+
+    num_shards = shards[0]['num shards']
+    missing_shards = sorted(set(range(num_shards)) - set(shard['shard'] for shard in shards))
+
+    sizes, outputs = dict(), dict()
+    for shard in shards:
+        assert shard['num shards'] == num_shards, "Shards come from runs with different shard counts"
+        for ds_name, num_items in shard['sizes'].items():
+            sizes[ds_name] = max(sizes.get(ds_name, 0), num_items)
+            outputs.setdefault(ds_name, dict()).update(shard['outputs'].get(ds_name, dict()))
+
+    merged, missing = dict(), dict()
+    for ds_name, num_items in sizes.items():
+        missing[ds_name] = [idx for idx in range(num_items) if idx not in outputs[ds_name]]
+        merged[ds_name] = [outputs[ds_name].get(idx, f'Missing instance {idx}') for idx in range(num_items)]
+    return merged, missing_shards, missing
@@ -0,0 +1,17 @@
+""" Submits each distinct call once and hands the same future to everyone who asks for it """
+class SharedCalls():
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.futures = dict()
+        self.num_requested = 0
+
+    def submit(self, key, fn, *args):
+        # key must identify the call up to prompt equivalence, e.g. (caller, point, search query)
+        self.num_requested += 1
+        if key not in self.futures:
+            self.futures[key] = self.llm.submit(fn, *args)
+        return self.futures[key]
+
+    def num_deduplicated(self):
+        return self.num_requested - len(self.futures)
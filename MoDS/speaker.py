@@ -1,34 +1,34 @@
-import tiktoken
+from output_schema import SPEAKER_FACTS
+from token_counter import count_tokens, fit_to_budget
 
 """ Agent responsible for a single document """
 class Speaker:
 
-    def __init__(self, retriever, llm, docs, doc_num):
+    def __init__(self, retriever, llm, docs, doc_num, token_counts=None):
         self.llm = llm
         self.retriever = retriever
-        encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
-        self.document = '\n'.join(self.prune_sources(docs, encoding))
+        self.document = '\n'.join(self.prune_sources(docs, token_counts))
         self.doc_num = doc_num
 
         self.discussion_point_definition = f"The discussion point should be short, around 5 words. "
         self.discussion_point_definition += f"It should be much more specific than the query, capturing a high-level theme or argument. "
         self.discussion_point_definition += f"Avoid overly broad terms like 'Impacts' or 'Benefits'; instead, provide focused terms that are still high-level themes. "
 
-    def prune_sources(self, docs, encoding):
-        pruned_docs = []
-        total_tokens = 0
-        for idx, doc in enumerate(docs):
-            if total_tokens > self.llm.token_limit:
-                print('pruned!')
-                return pruned_docs, pruned_idxs
-            pruned_docs.append(doc)
-            total_tokens += len(encoding.encode(doc))
-        return pruned_docs
+    def prune_sources(self, docs, token_counts=None):
+        # the longest run of paragraphs that fits the token limit, counting one token for each joining newline;
+        # token_counts are the paragraphs' precomputed counts, if the dataset has them
+        if token_counts == None:
+            token_counts = [count_tokens(doc) for doc in docs]
+        num_kept = fit_to_budget([count + 1 for count in token_counts], self.llm.token_limit)
+        if num_kept < len(docs):
+            print('pruned!')
+        return docs[:num_kept]
 
     def speak(self, query, discussion_point, rationale):
 
-        prompt = f"The following is a document related to the query: {query}"
-        prompt += f"\nDocument:\n{self.document}"
+        # the long document leads, so every call of this speaker shares it as a cacheable prefix
+        prompt = f"Document:\n{self.document}"
+        prompt += f"\n\nThe document above is related to the query: {query}"
         prompt += f"\n\nUsing the document, generate two lists of factual sentences, a \"yes\" list and \"no\" list, related to the query. "
         prompt += f"The \"yes\" list should only contain facts for why the answer to the query under the discussion point is yes, and the \"no\" list should only contain facts for why the answer to the query under the discussion point is no. "
         prompt += f"The lists for yes facts or no facts should be empty if no fact for that answer exists. "
@@ -38,7 +38,7 @@ class Speaker:
         if rationale != None:
             prompt += f"\n\nAn external moderator gave the following rationale to justify why you are appropriate to produce facts for this discussion point: {rationale} "
         
-        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'])
+        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'], schema=SPEAKER_FACTS, tag='speaker.speak')
         return parsed_out
 
     def speak_rag(self, query, top_k, discussion_point, search_query):
@@ -47,8 +47,8 @@ class Speaker:
 
         context = ' '.join(self.retriever.retrieve(search_query, top_k, self.doc_num))
 
-        prompt = f"The following is a document related to the query: {query}"
-        prompt += f"\nDocument:\n{context}"
+        prompt = f"Document:\n{context}"
+        prompt += f"\n\nThe document above is related to the query: {query}"
         prompt += f"\n\nUsing the document, generate two lists of factual sentences, a \"yes\" list and \"no\" list, related to the query. "
         prompt += f"The \"yes\" list should only contain facts for why the answer to the query under the discussion point is yes, and the \"no\" list should only contain facts for why the answer to the query under the discussion point is no. "
         prompt += f"The lists for yes facts or no facts should be empty if no fact for that answer exists. "
@@ -58,15 +58,15 @@ class Speaker:
 
         #print(prompt)
         
-        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'])
+        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'], schema=SPEAKER_FACTS, tag='speaker.speak_rag')
         return parsed_out
 
     def speak_retrieve_all(self, query, retr_docs, retr_idxs, discussion_point):
 
         context = '\n'.join([f'Document {retr_idxs[idx] + 1}: {d}' for idx, d in enumerate(retr_docs)])
 
-        prompt = f"The following is a document related to the query: {query}"
-        prompt += f"\n{context}"
+        prompt = f"Documents:\n{context}"
+        prompt += f"\n\nThe documents above are related to the query: {query}"
         prompt += f"\n\nUsing the document, generate two lists of factual sentences, a \"yes\" list and \"no\" list, related to the query. "
         prompt += f"The \"yes\" list should only contain facts for why the answer to the query under the discussion point is yes, and the \"no\" list should only contain facts for why the answer to the query under the discussion point is no. "
         prompt += f"The lists for yes facts or no facts should be empty if no fact for that answer exists. "
@@ -74,5 +74,5 @@ class Speaker:
         prompt += f"Only produce facts that are directly related to discussion point of \"{discussion_point}\". "
         prompt += f"Your output must be a JSON dictionary with keys \"discussion point\" for the discussion point, \"yes facts\" for the list of yes facts, and \"no facts\" for the list of no facts"
         
-        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'])
+        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Yes facts', 'No facts'], schema=SPEAKER_FACTS, tag='speaker.speak_retrieve_all')
         return parsed_out
\ No newline at end of file
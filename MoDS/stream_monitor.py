@@ -0,0 +1,87 @@
+""" Incremental check of a streamed JSON-mode completion, to stop generations that cannot fit the expected schema """
+class JSONStreamMonitor():
+
+    def __init__(self, schema=None):
+        self.schema = schema
+        self.started = False
+        self.closed = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.state = 'key'
+        self.key = None
+        self.key_chars = []
+
+    def expected_type(self, key):
+        # keys like "document {} question" match any document number
+        for schema_key, value_type in self.schema.items():
+            if schema_key == key:
+                return value_type
+            prefix, _, suffix = schema_key.partition('{}')
+            if '{}' in schema_key and key.startswith(prefix) and key.endswith(suffix) and key[len(prefix):len(key) - len(suffix)].isdigit():
+                return value_type
+        return None
+
+    def check_value_start(self, char):
+        if self.schema == None:
+            return None
+        value_type = self.expected_type(self.key.lower().replace('_', ' ').replace(':', ''))
+        if value_type == None:
+            return None
+        expected_chars = '[' if type(value_type) == list else '"' if value_type == str else '-0123456789'
+        if char not in expected_chars:
+            return f'"{self.key}" does not start like the expected value'
+        return None
+
+    def feed(self, text):
+        # returns why the output can no longer be valid, or None while it still can
+        for char in text:
+            if self.closed:
+                return None
+            if not self.started:
+                if char.isspace():
+                    continue
+                if char != '{':
+                    return 'output does not start with a JSON object'
+                self.started = True
+                self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.state == 'key':
+                        self.key = ''.join(self.key_chars)
+                        self.state = 'colon'
+                elif self.depth == 1 and self.state == 'key':
+                    self.key_chars.append(char)
+                continue
+
+            if char.isspace():
+                continue
+            if self.depth == 1 and self.state == 'value':
+                reason = self.check_value_start(char)
+                if reason != None:
+                    return reason
+                self.state = 'in value'
+
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.state == 'key':
+                    self.key_chars = []
+            elif char == ':' and self.depth == 1 and self.state == 'colon':
+                self.state = 'value'
+            elif char == ',' and self.depth == 1:
+                self.state = 'key'
+            elif char in '[{':
+                self.depth += 1
+            elif char in ']}':
+                self.depth -= 1
+                if self.depth == 0:
+                    # a finished object is left to validation and repair, not aborted
+                    self.closed = True
+        return None
@@ -0,0 +1,177 @@
+import argparse
+from summarizer import Summarizer
+from llm import ConcurrentLLM
+from llm_cache import ResponseCache
+from rate_limiter import RateLimiter
+from call_log import CallLog, BudgetExceeded, reset_call_log, summarize_call_log
+from mock_llm import build_client
+from sharding import parse_shard, shard_range, shard_suffix, save_shard
+from journal import Journal, END, iter_records
+import collections
+import pickle
+import tqdm
+import traceback
+
+from dotenv import load_dotenv, find_dotenv
+env_path = ''
+load_dotenv(env_path)
+
+# mode: summarizer method rerunning one outline on its own, used when its batched calls failed
+MODES = {
+    'full': 'summarize_outline_full',
+    'ind': 'summarize_outline_ind_async',
+    'ind_no_q': 'summarize_outline_ind_no_q_async',
+    'nomod': 'summarize_outline_full_nomod',
+    'ind_nomod': 'summarize_outline_ind_nomod_async',
+    'refine': 'summarize_outline_refine'
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize the outlines from the agentic framework in several modes, in one pass over the outlines.')
+    parser.add_argument('--run_name', type=str, default="default_run", help='Run name to identify the inference type.')
+    parser.add_argument('--res_dir', type=str, default="./", help='Directory for the results')
+    parser.add_argument('--modes', nargs='+', type=str, default=["full", "ind"], help=f'Summarizer modes, any of {", ".join(MODES)}. Enter multiple values separated by spaces.')
+    parser.add_argument('--input', type=str, default="pickle", help='Read the outlines from the compacted mods "pickle", or stream them from the run "journal" of the shard')
+    parser.add_argument('--follow', type=str, default="False", help='Follow the journal while run_mods.py is still appending to it, until the run finishes?')
+    parser.add_argument('--poll', type=float, default=5.0, help='Seconds between checks for new instances when following the journal')
+    parser.add_argument('--follow_timeout', type=float, default=0.0, help='Stop following the journal after this many seconds without a new instance (0 to wait for the run to finish)')
+    parser.add_argument('--use_cot', type=str, default="False", help='Use CoT?')
+    parser.add_argument('--use_rationale', type=str, default="False", help='Use the Rationale?')
+    parser.add_argument('--num_points', type=int, default=3, help='Number of points to generate')
+    parser.add_argument('--use_subtopic_retrieval', type=str, default="True", help='Use the subtopic for retrieval in round two?')
+    parser.add_argument('--select_agents', type=str, default="True", help='Should the moderator select a subset of agents?')
+    parser.add_argument('--cache_path', type=str, default="./llm_cache.db", help='SQLite file for the LLM response cache')
+    parser.add_argument('--cache_size', type=int, default=200000, help='Maximum number of cached LLM responses')
+    parser.add_argument('--bypass_cache', type=str, default="False", help='Skip the LLM response cache?')
+    parser.add_argument('--max_in_flight', type=int, default=8, help='Maximum number of concurrent LLM requests')
+    parser.add_argument('--window', type=int, default=32, help='Maximum number of outlines with calls in flight (0 for no limit)')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute allowed by the deployment (0 for no limit)')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute allowed by the deployment (0 for no limit)')
+    parser.add_argument('--rate_limit_path', type=str, default="", help='State file to share the rate limit across processes')
+    parser.add_argument('--shard', type=str, default="0/1", help='Summarize only shard i of N ("i/N"); merge the shard outputs with merge_shards.py')
+    parser.add_argument('--call_log', type=str, default="calls_summary.jsonl", help='JSONL file (under res_dir/run_name) logging every LLM call; empty to disable')
+    parser.add_argument('--usd_per_1k_prompt', type=float, default=0.0, help='Price per 1K prompt tokens, for cost accounting')
+    parser.add_argument('--usd_per_1k_completion', type=float, default=0.0, help='Price per 1K completion tokens, for cost accounting')
+    parser.add_argument('--max_calls', type=int, default=0, help='Abort once this many LLM calls were made (0 for no limit)')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Abort before using more than this many tokens (0 for no limit)')
+    parser.add_argument('--max_usd', type=float, default=0.0, help='Abort before spending more than this many dollars (0 for no limit)')
+    parser.add_argument('--backend', type=str, default="azure", help='LLM backend: "azure", or "mock" for the offline stand-in')
+    parser.add_argument('--mock_latency', type=float, default=1.0, help='Mean latency in seconds of the mock backend')
+    parser.add_argument('--mock_failure_rate', type=float, default=0.0, help='Fraction of mock calls failing with a server error')
+    parser.add_argument('--mock_rate_limit_rate', type=float, default=0.0, help='Fraction of mock calls failing with a 429')
+    parser.add_argument('--json_mode', type=str, default="False", help='Request JSON outputs and repair ones not matching the expected schema?')
+    parser.add_argument('--stream', type=str, default="False", help='Stream completions, logging time-to-first-token and stopping bad JSON outputs early?')
+    args = parser.parse_args(argv)
+    return args
+
+def summarize_outline(curr_outline, summarizer, mode, num_tries=0, max_tries=5):
+
+    if type(curr_outline) == type(''):
+        return curr_outline
+
+    try:
+        summ = getattr(summarizer, MODES[mode])(curr_outline)
+        return summ
+    except BudgetExceeded as e:
+        raise e
+    except Exception as e:
+        excep = traceback.format_exc()
+        print("Overall Exception:", excep)
+        if num_tries == max_tries - 1:
+            return str(excep)
+        return summarize_outline(curr_outline, summarizer, mode, num_tries=num_tries+1, max_tries=max_tries)
+
+def shard_outlines(out, shard_num, num_shards):
+    # (dataset, idx) and outline of every instance in the shard, handed out one at a time
+    for k, v in out.items():
+        start, end = shard_range(len(v), shard_num, num_shards)
+        for idx in range(start, end):
+            yield (k, idx), v[idx]
+
+def journal_outlines(path, sizes, follow, poll, timeout):
+    # (dataset, idx) and outline of every journaled instance, in the order run_mods.py finished them; the record closing
+    # the run fills sizes
+    for ds_name, idx, output in iter_records(path, follow, poll, timeout):
+        if ds_name == END:
+            sizes.update(output)
+            continue
+        yield (ds_name, idx), output
+
+def main(args):
+
+    for mode in args.modes:
+        assert mode in MODES, f"Unknown summarizer mode {mode}"
+
+    use_cot = (args.use_cot == 'True')
+    use_rationale = (args.use_rationale == 'True')
+    USE_POINT_RETRIEVAL = (args.use_subtopic_retrieval == 'True')
+    SELECT_AGENTS = (args.select_agents == 'True')
+    in_path = f'{args.res_dir}/{args.run_name}/mods_{use_cot}-CoT_{use_rationale}-Rationale_{USE_POINT_RETRIEVAL}-PointRetrieval_{SELECT_AGENTS}-Select'
+    shard_num, num_shards = parse_shard(args.shard)
+    suffix = shard_suffix(shard_num, num_shards) if num_shards > 1 else ''
+
+    sizes = dict()
+    if args.input == 'journal':
+        # the journal of a shard only holds that shard's instances
+        outlines = journal_outlines(f'{in_path}{suffix}.journal', sizes, args.follow == 'True', args.poll, args.follow_timeout)
+        num_outlines = None
+    else:
+        with open(f'{in_path}.pkl', 'rb') as handle:
+            out = pickle.load(handle)
+        sizes.update({k: len(v) for k, v in out.items()})
+        outlines = shard_outlines(out, shard_num, num_shards)
+        num_outlines = sum(end - start for start, end in [shard_range(len(v), shard_num, num_shards) for v in out.values()])
+
+    # one client, cache, rate limit and call log for every mode
+    cache = ResponseCache(args.cache_path, args.cache_size, args.bypass_cache == 'True')
+    call_log_path = f'{args.res_dir}/{args.run_name}/{args.call_log.replace(".jsonl", "")}{suffix}.jsonl' if args.call_log != '' else None
+    if call_log_path != None:
+        # a new log per run (and shard), as the summary journals are
+        reset_call_log(call_log_path)
+    call_log = CallLog(call_log_path, args.usd_per_1k_prompt, args.usd_per_1k_completion, args.max_calls, args.max_tokens, args.max_usd)
+    rate_limiter = RateLimiter(args.rpm, args.tpm, args.rate_limit_path if args.rate_limit_path != '' else None) if args.rpm > 0 or args.tpm > 0 else None
+    llm = ConcurrentLLM('GPT4', 0.0, 127000, cache, args.max_in_flight, rate_limiter, call_log, build_client(args), args.json_mode == 'True', 2, args.stream == 'True')
+    summarizer = Summarizer(llm, args.num_points)
+
+    # summaries are journaled as they come in, so memory stays flat and finished instances survive a crash
+    out_path = f'{in_path}_summary'
+    journals = {mode: Journal(f'{out_path}_{mode}{suffix}.journal', reset=True) for mode in args.modes}
+
+    # outlines with calls in flight, in order, for rerunning one whose batched calls failed
+    in_flight = collections.deque()
+    def track(outlines):
+        for instance, outline in outlines:
+            in_flight.append(outline)
+            yield instance, outline
+
+    results = summarizer.summarize_outlines_modes(track(outlines), args.modes, args.window if args.window > 0 else None)
+    try:
+        for (k, idx), mode_results in tqdm.tqdm(results, total=num_outlines):
+            outline = in_flight.popleft()
+            call_log.instance = (k, idx)
+            for mode, result in mode_results.items():
+                if isinstance(result, BudgetExceeded):
+                    raise result
+                # an outline whose batched calls failed is rerun on its own, with the usual retries
+                journals[mode].append(k, idx, summarize_outline(outline, summarizer, mode) if isinstance(result, Exception) else result)
+    except BudgetExceeded as e:
+        # the summaries finished so far are journaled and still written out, with placeholders for the rest
+        print('Stopping run:', e)
+
+    for mode, journal in journals.items():
+        if num_shards > 1:
+            outputs = journal.outputs_by_index(list(sizes.keys()))
+            # a journal that was not followed to the end of its run has no sizes, so they come from the instances seen
+            run_sizes = {k: sizes.get(k, max(v.keys(), default=-1) + 1) for k, v in outputs.items()}
+            save_shard(f'{out_path}_{mode}{suffix}.pkl', shard_num, num_shards, run_sizes, outputs)
+        else:
+            with open(f'{out_path}_{mode}.pkl', 'wb') as handle:
+                pickle.dump(journal.compact(list(sizes.keys()), sizes), handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    print('LLM cache:', cache.stats())
+    if call_log_path != None:
+        print('LLM calls:', summarize_call_log(call_log_path, call_log_path.replace('.jsonl', '') + '_summary.csv'))
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
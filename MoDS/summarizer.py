@@ -1,11 +1,13 @@
-import tiktoken
+import collections
 import random
+from concurrent.futures import Future
+from output_schema import POINT_SUMMARY, outline_summary_schema
+from token_counter import count_tokens, fit_to_budget
 
 class Summarizer:
 
     def __init__(self, llm, num_points):
         self.llm = llm
-        self.encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
 
         self.discussion_point_definition = f"The discussion point should be short, around 5 words. "
         self.discussion_point_definition += f"It should be much more specific than the query, capturing a high-level theme or argument. "
@@ -14,222 +16,338 @@ class Summarizer:
         json_keys = [[f'discussion point {idx + 1}', f'summary {idx + 1}'] for idx in range(num_points)]
         self.json_keys = [x for xs in json_keys for x in xs]
         self.json_keys_quoted = ", ".join(['"' + x + '"' for x in self.json_keys])
+        self.json_schema = outline_summary_schema(num_points)
         self.num_points = num_points
 
     def update_init(self, num_points):
         json_keys = [[f'discussion point {idx + 1}', f'summary {idx + 1}'] for idx in range(num_points)]
         self.json_keys = [x for xs in json_keys for x in xs]
         self.json_keys_quoted = ", ".join(['"' + x + '"' for x in self.json_keys])
+        self.json_schema = outline_summary_schema(num_points)
         self.num_points = num_points
     
-    def prune_sources(self, docs, doc_idxs):
-        pruned_docs = []
-        pruned_idxs = []
-        total_tokens = 0
-        for idx, doc in enumerate(docs):
-            if total_tokens > self.llm.token_limit:
-                print('pruned!')
-                return pruned_docs, pruned_idxs
-            pruned_docs.append(doc)
-            pruned_idxs.append(doc_idxs[idx])
-            total_tokens += len(self.encoding.encode(doc))
-        return pruned_docs, pruned_idxs
+    def prune_sources(self, docs, doc_idxs, token_counts=None):
+        # the longest run of documents that fits the token limit, counting one token for each joining newline;
+        # token_counts are the documents' precomputed counts, if the caller has them
+        if token_counts == None:
+            token_counts = [count_tokens(doc) for doc in docs]
+        num_kept = fit_to_budget([count + 1 for count in token_counts], self.llm.token_limit)
+        if num_kept < len(docs):
+            print('pruned!')
+        return docs[:num_kept], doc_idxs[:num_kept]
+
+    def prune_sources_collection(self, docs, doc_idxs, token_counts=None):
+        # same budget over the paragraphs of every document in order; the last kept document may be cut short.
+        # token_counts are per document and paragraph, like the dataset's doc_token_counts column. As before, the
+        # returned indices are positions in docs, not entries of doc_idxs
+        if token_counts == None:
+            token_counts = [[count_tokens(doc) for doc in docs_] for docs_ in docs]
+        num_kept = fit_to_budget([count + 1 for counts in token_counts for count in counts], self.llm.token_limit)
+        if num_kept < sum(len(docs_) for docs_ in docs):
+            print('pruned!')
 
-    def prune_sources_collection(self, docs, doc_idxs):
         pruned_docs = []
         pruned_idxs = []
-        total_tokens = 0
         for idx, docs_ in enumerate(docs):
-            pruned_docs.append([])
-            pruned_idxs.append(None)
-            for doc in docs_:
-                if total_tokens > self.llm.token_limit:
-                    print('pruned!')
-                    return pruned_docs, pruned_idxs
-                pruned_docs[-1].append(doc)
-                pruned_idxs[-1] = idx
-
-        if pruned_idxs[-1] == None:
-            pruned_docs.pop(-1)
-            pruned_idxs.pop(-1)
-
+            if num_kept == 0:
+                break
+            pruned_docs.append(docs_[:num_kept])
+            pruned_idxs.append(idx)
+            num_kept -= len(pruned_docs[-1])
         return pruned_docs, pruned_idxs
     
-    def summarize_outline_ind(self, outline):
+    def gather_points(self, point_outs):
 
         final_out = dict()
-        
-        for idx in range(self.num_points):
-            
-            prompt = f"The following is an outline for the query {outline.query} and a single discussion point. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
-            prompt += self.print_outline_ind(outline, idx)
-            prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
-            prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
-            prompt += "Use as many documents as possible. "
-            prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
-    
-            parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"])
-            
+        for idx, parsed_out in enumerate(point_outs):
             final_out[f'discussion point {idx+1}'] = parsed_out['discussion point']
             final_out[f'summary {idx+1}'] = parsed_out['summary']
-            
         return final_out
 
+    def summarize_point_ind(self, outline, idx, sections=None):
+
+        if sections == None:
+            sections = self.parse_outline(outline)
+
+        prompt = f"The following is an outline for a query and a single discussion point. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
+        prompt += '\n\n'.join([sections[0], sections[idx + 1]])
+        prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
+        prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
+        prompt += "Use as many documents as possible. "
+        prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
+
+        parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"], tag='summarizer.summarize_point_ind', schema=POINT_SUMMARY)
+        return parsed_out
+
+    def summarize_outline_ind(self, outline):
+        sections = self.parse_outline(outline)
+        return self.gather_points([self.summarize_point_ind(outline, idx, sections) for idx in range(self.num_points)])
+
+    def summarize_outline_ind_async(self, outline):
+        sections = self.parse_outline(outline)
+        futures = [self.llm.submit(self.summarize_point_ind, outline, idx, sections) for idx in range(self.num_points)]
+        return self.gather_points([future.result() for future in futures])
+
+    def summarize_point_ind_no_q(self, outline, idx, sections=None):
+
+        if sections == None:
+            sections = self.parse_outline_no_q(outline)
+
+        prompt = f"The following is an outline for a query and a single discussion point. Under the discussion point, there is a list of documents. Under each document, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
+        prompt += '\n\n'.join([sections[0], sections[idx + 1]])
+        prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
+        prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
+        prompt += "Use as many documents as possible. "
+        prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
+
+        parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"], tag='summarizer.summarize_point_ind_no_q', schema=POINT_SUMMARY)
+        return parsed_out
+
     def summarize_outline_ind_no_q(self, outline):
+        sections = self.parse_outline_no_q(outline)
+        return self.gather_points([self.summarize_point_ind_no_q(outline, idx, sections) for idx in range(self.num_points)])
 
-        final_out = dict()
-        
-        for idx in range(self.num_points):
-            
-            prompt = f"The following is an outline for the query {outline.query} and a single discussion point. Under the discussion point, there is a list of documents. Under each document, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
-            prompt += self.print_outline_ind_no_q(outline, idx)
-            prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
-            prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
-            prompt += "Use as many documents as possible. "
-            prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
-    
-            parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"])
-            
-            final_out[f'discussion point {idx+1}'] = parsed_out['discussion point']
-            final_out[f'summary {idx+1}'] = parsed_out['summary']
-            
-        return final_out
-    
-    def summarize_outline_full(self, outline):
-        
-        prompt = f"The following is an outline for the query {outline.query}, broken down into {self.num_points} fine-grained discussion points. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
-        prompt += self.print_outline_full(outline)
+    def summarize_outline_ind_no_q_async(self, outline):
+        sections = self.parse_outline_no_q(outline)
+        futures = [self.llm.submit(self.summarize_point_ind_no_q, outline, idx, sections) for idx in range(self.num_points)]
+        return self.gather_points([future.result() for future in futures])
+
+    def summarize_outlines_modes(self, items, modes, window=None):
+        # one pass over (instance, outline) items for several modes: an outline is rendered once per layout its modes need,
+        # and the calls of every mode are submitted together; yields (instance, {mode: summary dict, or the exception it
+        # raised}) in item order. With a window, at most that many outlines are in flight, so items can be a stream
+        renders = {'full': self.parse_outline, 'refine': self.parse_outline, 'ind': self.parse_outline, 'ind_no_q': self.parse_outline_no_q, 'nomod': self.parse_outline_nomod, 'ind_nomod': self.parse_outline_nomod}
+        summarize_points = {'ind': self.summarize_point_ind, 'ind_no_q': self.summarize_point_ind_no_q, 'ind_nomod': self.summarize_point_ind_nomod}
+
+        pending = collections.deque()
+        for instance, outline in items:
+            pending.append((instance, self.submit_modes(outline, modes, instance, renders, summarize_points)))
+            while window != None and len(pending) > window:
+                instance, futures = pending.popleft()
+                yield instance, self.gather_modes(futures)
+        while len(pending) > 0:
+            instance, futures = pending.popleft()
+            yield instance, self.gather_modes(futures)
+
+    def submit_modes(self, outline, modes, instance, renders, summarize_points):
+        if type(outline) == type(''):
+            return {mode: outline for mode in modes}
+
+        # the summarize methods take sections, the outline as already rendered by the mode's parse method, so the modes and
+        # points of an outline share one render
+        sections = dict()
+        futures = dict()
+        for mode in modes:
+            parse = renders[mode]
+            if parse not in sections:
+                try:
+                    sections[parse] = parse(outline)
+                except Exception as e:
+                    sections[parse] = e
+            if isinstance(sections[parse], Exception):
+                futures[mode] = sections[parse]
+            elif mode in summarize_points:
+                futures[mode] = [self.llm.submit(self.run_for_instance, instance, summarize_points[mode], outline, idx, sections[parse]) for idx in range(self.num_points)]
+            elif mode == 'nomod':
+                futures[mode] = self.llm.submit(self.run_for_instance, instance, self.summarize_outline_full_nomod, outline, sections[parse])
+
+        # refine works on the full summary, so both modes share its call
+        if 'full' in modes or 'refine' in modes:
+            full_sections = sections[self.parse_outline]
+            full_future = full_sections if isinstance(full_sections, Exception) else self.llm.submit(self.run_for_instance, instance, self.summarize_outline_full, outline, full_sections)
+            if 'full' in modes:
+                futures['full'] = full_future
+            if 'refine' in modes:
+                futures['refine'] = full_future if isinstance(full_future, Exception) else self.submit_after(full_future, instance, self.refine_outline_summary, outline.query)
+        return futures
+
+    def submit_after(self, future, instance, fn, *args):
+        # a future for fn(result of future, *args), submitted once future is done, so no pool thread waits on another
+        chained = Future()
+
+        def copy_result(done):
+            if done.exception() != None:
+                chained.set_exception(done.exception())
+            else:
+                chained.set_result(done.result())
+
+        def submit_next(done):
+            if done.exception() != None:
+                chained.set_exception(done.exception())
+                return
+            self.llm.submit(self.run_for_instance, instance, fn, done.result(), *args).add_done_callback(copy_result)
+
+        future.add_done_callback(submit_next)
+        return chained
+
+    def gather_modes(self, futures):
+        results = dict()
+        for mode, mode_futures in futures.items():
+            try:
+                if type(mode_futures) == list:
+                    results[mode] = self.gather_points([future.result() for future in mode_futures])
+                elif isinstance(mode_futures, Future):
+                    results[mode] = mode_futures.result()
+                else:
+                    # an error string from mods, or the exception rendering the outline raised
+                    results[mode] = mode_futures
+            except Exception as e:
+                results[mode] = e
+        return results
+
+    def run_for_instance(self, instance, fn, *args):
+        # keeps the call log's per-instance accounting right while calls of many instances share the pool
+        if instance == None or self.llm.call_log == None:
+            return fn(*args)
+        with self.llm.call_log.for_instance(instance):
+            return fn(*args)
+
+    def summarize_outline_full(self, outline, sections=None):
+
+        if sections == None:
+            sections = self.parse_outline(outline)
+
+        prompt = f"The following is an outline for a query, broken down into {self.num_points} fine-grained discussion points. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
+        prompt += '\n\n'.join(sections)
         prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same {self.num_points} discussion points. The summary should be one brief, three-sentence paragraph per point. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += f"Your final output must be a JSON dictionary with keys for {self.json_keys_quoted}. "
 
-        parsed_out = self.llm.generate(prompt, self.json_keys)
+        parsed_out = self.llm.generate(prompt, self.json_keys, tag='summarizer.summarize_outline_full', schema=self.json_schema)
+        return parsed_out
+
+    def summarize_point_ind_nomod(self, outline, idx, sections=None):
+
+        if sections == None:
+            sections = self.parse_outline_nomod(outline)
+
+        prompt = f"The following is an outline for a query and a single discussion point. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
+        prompt += '\n\n'.join([sections[0], sections[idx + 1]])
+        prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
+        prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
+        prompt += "Use as many documents as possible. "
+        prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
+
+        parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"], tag='summarizer.summarize_point_ind_nomod', schema=POINT_SUMMARY)
         return parsed_out
 
     def summarize_outline_ind_nomod(self, outline):
+        sections = self.parse_outline_nomod(outline)
+        return self.gather_points([self.summarize_point_ind_nomod(outline, idx, sections) for idx in range(self.num_points)])
 
-        final_out = dict()
-        
-        for idx in range(self.num_points):
-            
-            prompt = f"The following is an outline for the query {outline.query} and a single discussion point. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
-            prompt += self.print_outline_ind_nomod(outline, idx)
-            prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same discussion point. The summary should be one brief, three-sentence paragraph. "
-            prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
-            prompt += "Use as many documents as possible. "
-            prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
-    
-            parsed_out = self.llm.generate(prompt, ["Discussion point", "Summary"])
-            
-            final_out[f'discussion point {idx+1}'] = parsed_out['discussion point']
-            final_out[f'summary {idx+1}'] = parsed_out['summary']
-            
-        return final_out
-    
-    def summarize_outline_full_nomod(self, outline):
-        
-        prompt = f"The following is an outline for the query {outline.query}, broken down into {self.num_points} fine-grained discussion points. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
-        prompt += self.print_outline_full_nomod(outline)
+    def summarize_outline_ind_nomod_async(self, outline):
+        sections = self.parse_outline_nomod(outline)
+        futures = [self.llm.submit(self.summarize_point_ind_nomod, outline, idx, sections) for idx in range(self.num_points)]
+        return self.gather_points([future.result() for future in futures])
+
+    def summarize_outline_full_nomod(self, outline, sections=None):
+
+        if sections == None:
+            sections = self.parse_outline_nomod(outline)
+
+        prompt = f"The following is an outline for a query, broken down into {self.num_points} fine-grained discussion points. Under the discussion point, there is a list of documents and a subquestion explaining the document's expertise on the discussion point. Under each document and question, there will be a bullet point list of facts preceded by either \"Yes Fact:\" and \"No Fact:\", denoting whether the fact gives evidence for why the answer to the query is yes or no:\n"
+        prompt += '\n\n'.join(sections)
         prompt += f"\n\nSynthesize the Yes Facts and No Facts from the outline and produce a brief summary that answers the query under the same {self.num_points} discussion points. The summary should be one brief, three-sentence paragraph per point. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += f"Your final output must be a JSON dictionary with keys for {self.json_keys_quoted}. "
 
-        parsed_out = self.llm.generate(prompt, self.json_keys)
+        parsed_out = self.llm.generate(prompt, self.json_keys, tag='summarizer.summarize_outline_full_nomod', schema=self.json_schema)
         return parsed_out
 
-    def summarize_docs(self, query, docs, doc_idxs):
+    def summarize_docs(self, query, docs, doc_idxs, token_counts=None):
 
-        pruned_docs, pruned_idxs = self.prune_sources_collection(docs, doc_idxs)
+        pruned_docs, pruned_idxs = self.prune_sources_collection(docs, doc_idxs, token_counts)
 
         doc_texts = [f'Document {pruned_idxs[idx] + 1}: {" ".join(d)}' for idx, d in enumerate(pruned_docs)]
         doc_text = '\n'.join(doc_texts)
 
-        prompt = f"The following are documents for the query: {query}\n"
-        prompt += doc_text
+        prompt = f"Documents:\n{doc_text}"
+        prompt += f"\n\nThe documents above are for the query: {query}"
         prompt += f"\n\nSynthesize the facts from the document and produce a brief summary that answers the query under {self.num_points} fine-grained discussion points. The summary should have one brief, three-sentence paragraph per point. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += self.discussion_point_definition
         prompt += f"Your final output must be a JSON dictionary with keys for {self.json_keys_quoted}. "
 
-        parsed_out = self.llm.generate(prompt, self.json_keys)
+        parsed_out = self.llm.generate(prompt, self.json_keys, tag='summarizer.summarize_docs', schema=self.json_schema)
         return parsed_out
 
-    def summarize_docs_flat(self, query, docs, doc_idxs):
+    def summarize_docs_flat(self, query, docs, doc_idxs, token_counts=None):
 
-        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs)
+        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs, token_counts)
 
         doc_texts = [f'Document {pruned_idxs[idx] + 1}: {d}' for idx, d in enumerate(pruned_docs)]
         doc_text = '\n'.join(doc_texts)
 
-        prompt = f"The following are documents for the query: {query}\n"
-        prompt += doc_text
+        prompt = f"Documents:\n{doc_text}"
+        prompt += f"\n\nThe documents above are for the query: {query}"
         prompt += f"\n\nSynthesize the facts from the document and produce a summary that answers the query under {self.num_points} fine-grained discussion points. The summary should be one brief, three-sentence paragraph per point. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += self.discussion_point_definition
         prompt += f"Your final output must be a JSON dictionary with keys for {self.json_keys_quoted}. "
 
-        parsed_out = self.llm.generate(prompt, self.json_keys)
+        parsed_out = self.llm.generate(prompt, self.json_keys, tag='summarizer.summarize_docs_flat', schema=self.json_schema)
         return parsed_out
 
-    def summarize_docs_flat_point(self, query, point, docs, doc_idxs):
+    def summarize_docs_flat_point(self, query, point, docs, doc_idxs, token_counts=None):
 
-        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs)
+        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs, token_counts)
 
         doc_texts = [f'Document {pruned_idxs[idx] + 1}: {d}' for idx, d in enumerate(pruned_docs)]
         doc_text = '\n'.join(doc_texts)
 
-        prompt = f"The following are documents for the query: {query} and discussion point: {point}\n"
-        prompt += doc_text
+        # the documents lead and the point follows, so the calls for every point share the documents as a prefix
+        prompt = f"Documents:\n{doc_text}"
+        prompt += f"\n\nThe documents above are for the query: {query} and discussion point: {point}"
         prompt += f"\n\nSynthesize the facts from the document and produce a summary that answers the query related to the discussion point. The summary should be one brief, three-sentence paragraph. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += self.discussion_point_definition
         prompt += f"Your final output must be a JSON dictionary with keys for \"summary\". "
 
-        parsed_out = self.llm.generate(prompt, "summary")
+        parsed_out = self.llm.generate(prompt, "summary", tag='summarizer.summarize_docs_flat_point')
         return parsed_out
         
-    def summarize_docs_single(self, query, docs, doc_idxs):
+    def summarize_docs_single(self, query, docs, doc_idxs, token_counts=None):
 
-        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs)
+        pruned_docs, pruned_idxs = self.prune_sources(docs, doc_idxs, token_counts)
 
         doc_texts = [f'Document {pruned_idxs[idx] + 1}: {d}' for idx, d in enumerate(pruned_docs)]
         doc_text = '\n'.join(doc_texts)
 
-        prompt = f"The following are documents for the query: {query}\n"
-        prompt += doc_text
+        prompt = f"Documents:\n{doc_text}"
+        prompt += f"\n\nThe documents above are for the query: {query}"
         prompt += "\n\nSynthesize the facts from the document and produce a summary that answers the query under a single fine-grained discussion point. The summary should be one brief, three-sentence paragraph per point. "
         prompt += "Each sentence in the paragraph should include a citation, in the form of a number inside square brackets, indicating the source documents from which the information was derived. "
         prompt += "Use as many documents as possible. "
         prompt += self.discussion_point_definition
         prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
 
-        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Summary'])
+        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Summary'], tag='summarizer.summarize_docs_single', schema=POINT_SUMMARY)
         return parsed_out
 
     def summarize_one_doc(self, query, doc):
 
-        prompt = f"The following is a document for the query: {query}\n"
-        prompt += ' '.join(doc)
+        prompt = f"Document:\n{' '.join(doc)}"
+        prompt += f"\n\nThe document above is for the query: {query}"
         prompt += "\n\nSynthesize the facts from the document and produce a summary that answers the query."
         prompt += "Your final output must be a JSON dictionary with a key for \"summary\". "
 
-        parsed_out = self.llm.generate(prompt, ['Summary'])
+        parsed_out = self.llm.generate(prompt, ['Summary'], tag='summarizer.summarize_one_doc')
         return parsed_out
 
     def summarize_one_doc_point(self, query, doc, point):
 
-        prompt = f"The following is a document for the query: {query}\n"
-        prompt += ' '.join(doc)
+        prompt = f"Document:\n{' '.join(doc)}"
+        prompt += f"\n\nThe document above is for the query: {query}"
         prompt += f"\n\nSynthesize the facts from the document and produce a summary that answers the query and is related to the point {point}. "
         prompt += f"If there is no relevant information respond with \"N/A\" as your summary. "
         prompt += "Your final output must be a JSON dictionary with a key for \"summary\", and the value can be \"N/A\" if there is no relevant information. "
 
-        parsed_out = self.llm.generate(prompt, ['Summary'])
+        parsed_out = self.llm.generate(prompt, ['Summary'], tag='summarizer.summarize_one_doc_point')
         return parsed_out
 
     def refine_summary_ind(self, query, topic, summary):
@@ -241,7 +359,7 @@ class Summarizer:
         prompt += "Use as many documents as possible. "
         prompt += "Your final output must be a JSON dictionary with keys for \"discussion point\" and \"summary\". "
 
-        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Summary'])
+        parsed_out = self.llm.generate(prompt, ['Discussion point', 'Summary'], tag='summarizer.refine_summary_ind', schema=POINT_SUMMARY)
         return parsed_out
 
     def refine_summary_full(self, query, summary):
@@ -253,9 +371,16 @@ class Summarizer:
         prompt += "Use as many documents as possible. "
         prompt += f"Your final output must be a JSON dictionary with keys for {self.json_keys_quoted}. "
 
-        parsed_out = self.llm.generate(prompt, self.json_keys)
+        parsed_out = self.llm.generate(prompt, self.json_keys, tag='summarizer.refine_summary_full', schema=self.json_schema)
         return parsed_out
 
+    def refine_outline_summary(self, summary, query):
+        # summary is the {'discussion point i', 'summary i'} dict of summarize_outline_full
+        return self.refine_summary_full(query, '\n' + self.print_summary_full(summary))
+
+    def summarize_outline_refine(self, outline):
+        return self.refine_outline_summary(self.summarize_outline_full(outline), outline.query)
+
     def parse_outline_nostance(self, outline):
 
         sections = []
@@ -264,19 +389,16 @@ class Summarizer:
         
         for idx in range(self.num_points):
             topic = outline.topics[idx]
-            facts = outline.facts[idx]
             select_info = outline.topic_speakers[idx]
-        
-            curr_facts = outline.facts[idx]['facts']
-            curr_docs = outline.facts[idx]['doc_nums']
-            curr_labels = outline.facts[idx]['labels']
+            fact_groups = outline.get_fact_groups(idx)
 
             out = f'# Discussion Point {idx+1}: {topic}'
 
-            for doc_num in set(curr_docs):
+            # set(list(...)) visits documents in the same order set(doc_nums) always did, so prompts and cache keys are unchanged
+            for doc_num in set(list(fact_groups)):
                 out += f'\n## Document {doc_num + 1}: {select_info["document " + str(doc_num + 1) + " question"]}'
-                yes_facts = [f'- Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
-                no_facts = [f'- Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+                yes_facts = [f'- Fact: ' + fact for fact in fact_groups[doc_num]['yes']]
+                no_facts = [f'- Fact: ' + fact for fact in fact_groups[doc_num]['no']]
                 all_facts = yes_facts + no_facts
                 random.shuffle(all_facts)
                 fact_text = "\n".join(all_facts)
@@ -293,19 +415,15 @@ class Summarizer:
         
         for idx in range(self.num_points):
             topic = outline.topics[idx]
-            facts = outline.facts[idx]
             select_info = outline.topic_speakers[idx]
-        
-            curr_facts = outline.facts[idx]['facts']
-            curr_docs = outline.facts[idx]['doc_nums']
-            curr_labels = outline.facts[idx]['labels']
+            fact_groups = outline.get_fact_groups(idx)
 
             out = f'# Discussion Point {idx+1}: {topic}'
 
-            for doc_num in set(curr_docs):
+            for doc_num in set(list(fact_groups)):
                 out += f'\n## Document {doc_num + 1}: {select_info["document " + str(doc_num + 1) + " question"]}'
-                yes_facts = [f'- Yes Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
-                no_facts = [f'- No Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+                yes_facts = [f'- Yes Fact: ' + fact for fact in fact_groups[doc_num]['yes']]
+                no_facts = [f'- No Fact: ' + fact for fact in fact_groups[doc_num]['no']]
                 fact_text = "\n".join(yes_facts + no_facts)
                 out += f'\n{fact_text}'
             sections.append(out)
@@ -320,19 +438,15 @@ class Summarizer:
         
         for idx in range(self.num_points):
             topic = outline.topics[idx]
-            facts = outline.facts[idx]
             select_info = outline.topic_speakers[idx]
-        
-            curr_facts = outline.facts[idx]['facts']
-            curr_docs = outline.facts[idx]['doc_nums']
-            curr_labels = outline.facts[idx]['labels']
+            fact_groups = outline.get_fact_groups(idx)
 
             out = f'# Discussion Point {idx+1}: {topic}'
 
-            for doc_num in set(curr_docs):
+            for doc_num in set(list(fact_groups)):
                 out += f'\n## Document {doc_num + 1}:'
-                yes_facts = [f'- Yes Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
-                no_facts = [f'- No Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+                yes_facts = [f'- Yes Fact: ' + fact for fact in fact_groups[doc_num]['yes']]
+                no_facts = [f'- No Fact: ' + fact for fact in fact_groups[doc_num]['no']]
                 fact_text = "\n".join(yes_facts + no_facts)
                 out += f'\n{fact_text}'
             sections.append(out)
@@ -347,18 +461,14 @@ class Summarizer:
         
         for idx in range(self.num_points):
             topic = outline.topics[idx]
-            facts = outline.facts[idx]
-        
-            curr_facts = outline.facts[idx]['facts']
-            curr_docs = outline.facts[idx]['doc_nums']
-            curr_labels = outline.facts[idx]['labels']
+            fact_groups = outline.get_fact_groups(idx)
 
             out = f'# Discussion Point {idx+1}: {topic}'
 
-            for doc_num in set(curr_docs):
+            for doc_num in set(list(fact_groups)):
                 out += f'\n## Document {doc_num + 1}:'
-                yes_facts = [f'- Yes Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
-                no_facts = [f'- No Fact: ' + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+                yes_facts = [f'- Yes Fact: ' + fact for fact in fact_groups[doc_num]['yes']]
+                no_facts = [f'- No Fact: ' + fact for fact in fact_groups[doc_num]['no']]
                 fact_text = "\n".join(yes_facts + no_facts)
                 out += f'\n{fact_text}'
             sections.append(out)
@@ -384,22 +494,18 @@ class Summarizer:
                     out += f'## Discussion Point {idx+1}: {topic}'
 
             if idx < len(outline.topic_speakers) and idx < len(outline.facts):
-                facts = outline.facts[idx]
                 select_info = outline.topic_speakers[idx]
-            
-                curr_facts = outline.facts[idx]['facts']
-                curr_docs = outline.facts[idx]['doc_nums']
-                curr_labels = outline.facts[idx]['labels']
+                fact_groups = outline.get_fact_groups(idx)
 
-                for doc_num in set(curr_docs):
+                for doc_num in set(list(fact_groups)):
                     if self.see_doc_num:
                         out += f'\n#### Document {doc_num + 1}:'
 
                     if self.see_questions:
                         out += ('' if self.see_doc_num else '\n####') + f' {select_info["document " + str(doc_num + 1) + " question"]}'
 
-                    yes_facts = [f'- ' + (' <b><span style="color:green">Support</span>:</b> ') + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'yes' and curr_docs[idx] == doc_num]
-                    no_facts = [f'- ' + (' <b><span style="color:red">Refute</span>:</b> ') + curr_facts[idx] for idx in range(len(curr_docs)) if curr_labels[idx] == 'no' and curr_docs[idx] == doc_num]
+                    yes_facts = [f'- ' + (' <b><span style="color:green">Support</span>:</b> ') + fact for fact in fact_groups[doc_num]['yes']]
+                    no_facts = [f'- ' + (' <b><span style="color:red">Refute</span>:</b> ') + fact for fact in fact_groups[doc_num]['no']]
 
                     if self.see_support:
                         yes_fact_text = '\n'.join(yes_facts)
@@ -423,6 +529,9 @@ class Summarizer:
         self.see_doc_num = see_doc_num
         self.see_questions = see_questions
 
+    def print_summary_full(self, summary):
+        return '\n\n'.join([f'# Discussion Point {idx+1}: {summary[f"discussion point {idx+1}"]}\n{summary[f"summary {idx+1}"]}' for idx in range(self.num_points)])
+
     def print_outline_full_nomod(self, outline):
         sections = self.parse_outline_nomod(outline)
         return '\n\n'.join(sections)
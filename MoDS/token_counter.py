@@ -0,0 +1,42 @@
+import bisect
+import collections
+import hashlib
+import itertools
+import threading
+import tiktoken
+
+""" One shared tiktoken encoder, and a bounded memo of token counts for texts without precomputed counts """
+
+encoding = None
+encoding_lock = threading.Lock()
+# text digest: token count, least recently used first
+token_counts = collections.OrderedDict()
+token_counts_lock = threading.Lock()
+max_token_counts = 100000
+
+def get_encoding():
+    global encoding
+    with encoding_lock:
+        if encoding == None:
+            encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
+    return encoding
+
+def count_tokens(text):
+    # keyed on a digest rather than the text, so the memo does not keep dataset paragraphs alive
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with token_counts_lock:
+        count = token_counts.get(key)
+        if count != None:
+            token_counts.move_to_end(key)
+            return count
+
+    count = len(get_encoding().encode(text))
+    with token_counts_lock:
+        token_counts[key] = count
+        if len(token_counts) > max_token_counts:
+            token_counts.popitem(last=False)
+    return count
+
+def fit_to_budget(counts, budget):
+    # the number of leading items whose total stays within budget, by binary search over the running totals
+    return bisect.bisect_right(list(itertools.accumulate(counts)), budget)